@@ -1,15 +1,61 @@
 import os
-from flask import Flask, abort, jsonify, request
-from models import setup_db, Actor, Movie, Assign
+import zlib
+from flask import Flask, Response, abort, request, stream_with_context
+from models import setup_db, init_unit_of_work, commit, db, pool_stats, iter_rows, paginate, search, casts, changes_since, encode_cursor, decode_cursor, row_counts, bulk_insert, bulk_update, bulk_delete, existing_ids, patch_row, delete_row, Actor, Movie, Assign, Change
 from flask_cors import CORS
+import cache
+import idempotency
+import ratelimit
+from idempotency import idempotent
 from datetime import datetime
-from auth.auth import AuthError, requires_auth
+from auth.auth import AuthError, check_permissions, requires_auth, set_jwks_source, token_cache
+import metrics
+import serialization
+from serialization import jsonify
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    if 'SQLALCHEMY_DATABASE_URI' in app.config:
+        setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+    else:
+        setup_db(app)
     CORS(app)
+    app.config.setdefault('CAST_LOADING_STRATEGY', os.environ.get('CAST_LOADING_STRATEGY', 'selectin'))
+    app.config.setdefault('PAGE_SIZE', int(os.environ.get('PAGE_SIZE', 100)))
+    app.config.setdefault('MAX_PAGE_SIZE', int(os.environ.get('MAX_PAGE_SIZE', 1000)))
+    app.config.setdefault('SEARCH_LIMIT', int(os.environ.get('SEARCH_LIMIT', 10)))
+    app.config.setdefault('EXPORT_BATCH_SIZE', int(os.environ.get('EXPORT_BATCH_SIZE', 1000)))
+    app.config.setdefault('BATCH_CHUNK_SIZE', int(os.environ.get('BATCH_CHUNK_SIZE', 500)))
+    app.config.setdefault('RESPONSE_CACHE_URL', os.environ.get('RESPONSE_CACHE_URL', 'local'))
+    app.config.setdefault('RESPONSE_CACHE_SIZE', int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)))
+    app.config.setdefault('RESPONSE_CACHE_TTL', int(os.environ.get('RESPONSE_CACHE_TTL', 30)))
+    cache.init_app(app, app.config.get('RESPONSE_CACHE_BACKEND'))
+    app.config.setdefault('IDEMPOTENCY_URL', os.environ.get('IDEMPOTENCY_URL', 'local'))
+    app.config.setdefault('IDEMPOTENCY_SIZE', int(os.environ.get('IDEMPOTENCY_SIZE', 10000)))
+    app.config.setdefault('IDEMPOTENCY_TTL', int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600)))
+    app.config.setdefault('IDEMPOTENCY_WAIT', float(os.environ.get('IDEMPOTENCY_WAIT', 10)))
+    idempotency.init_app(app, app.config.get('IDEMPOTENCY_STORE'))
+    app.config.setdefault('METRICS_PATH', os.environ.get('METRICS_PATH', '/metrics'))
+    app.config.setdefault('SLOW_QUERY_MS', int(os.environ.get('SLOW_QUERY_MS', 0)))
+    metrics.init_app(app).add_gauges(lambda: cache_gauges(app))
+    # after metrics.init_app, so that the commits are timed
+    init_unit_of_work(app)
+    app.config.setdefault('RATE_LIMIT_URL', os.environ.get('RATE_LIMIT_URL', 'local'))
+    app.config.setdefault('RATE_LIMIT_SIZE', int(os.environ.get('RATE_LIMIT_SIZE', 100000)))
+    app.config.setdefault('RATE_LIMIT', ratelimit.parse_limit(os.environ.get('RATE_LIMIT', '0')))
+    app.config.setdefault('RATE_LIMITS', ratelimit.parse_limits(os.environ.get('RATE_LIMITS', '')))
+    app.config.setdefault('RATE_LIMIT_PROXIES', int(os.environ.get('RATE_LIMIT_PROXIES', 0)))
+    # after metrics.init_app, so that the 429s are counted
+    ratelimit.init_app(app, app.config.get('RATE_LIMIT_STORE'))
+    app.config.setdefault('COMPRESS_MIN_SIZE', int(os.environ.get('COMPRESS_MIN_SIZE', 1024)))
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', int(os.environ.get('COMPRESS_GZIP_LEVEL', 6)))
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4)))
+    serialization.init_app(app)
+    if 'JWKS_SOURCE' in app.config:
+        set_jwks_source(app.config['JWKS_SOURCE'], app.config.get('JWKS_TTL'))
 
     @app.route('/')
     def get_greeting():
@@ -22,23 +68,394 @@ def create_app(test_config=None):
     @app.route('/coolkids')
     def be_cool():
         return "Be cool, man, be coooool! You're almost a FSND grad!"
-    
-    @app.route('/actors', methods=['GET'])
-    def get_actors():
-        res = [actor.format() for actor in Actor.query.all()]
+
+    def fields_arg(model):
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else None
+        if fields and not set(fields) <= set(model.FIELDS):
+            abort(400)
+        return fields
+
+    INCLUDES = {Actor: ('counts',), Movie: ('counts', 'actors')}
+
+    def included():
+        include = request.args.get('include')
+        return set(include.split(',')) if include else set()
+
+    def include_arg(model):
+        include = included()
+        if not include <= set(INCLUDES[model]):
+            abort(400)
+        return include
+
+    def assign_tag(**kwargs):
+        # the counts and the casts change with every assign
+        return 'Assign' if included() & {'counts', 'actors'} else None
+
+    def cast_tag(**kwargs):
+        return 'Actor' if 'actors' in included() else None
+
+    '''
+    embed_casts(body)
+        ?include=actors: the `actor_ids` of every movie of the page, and
+        each of their actors once in body['actors'], loaded in one query
+    '''
+    def embed_casts(body):
+        if 'actors' not in include_arg(Movie):
+            return body
+        movies = body['movies']
+        cast_ids, body['actors'] = casts([movie['id'] for movie in movies])
+        for movie in movies:
+            movie['actor_ids'] = cast_ids.get(movie['id'], [])
+        return body
+
+    '''
+    page_args(model)
+        reads ?limit=, ?sort= (one of model.SORTS, `-` prefixed for descending order),
+        ?after= (the `next` value of the previous page)
+        and ?fields= (comma separated columns of model.FIELDS) for paginate.
+        ?include=counts adds model.COUNT_FIELD to the fields.
+    '''
+    def page_args(model):
+        sort = request.args.get('sort', 'id')
+        descending = sort.startswith('-')
+        sort = sort.lstrip('-')
+        if sort not in model.SORTS:
+            abort(400)
+        try:
+            limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+            after = request.args.get('after')
+            if after:
+                after = int(after) if sort == 'id' else decode_cursor(model, sort, after)
+            else:
+                after = None
+        except ValueError:
+            abort(400)
+        if limit <= 0:
+            abort(400)
+        fields = fields_arg(model)
+        if 'counts' in include_arg(model):
+            fields = list(fields or model.FIELDS) + [model.COUNT_FIELD]
+        return {
+            'after': after,
+            'limit': min(limit, app.config['MAX_PAGE_SIZE']),
+            'fields': fields,
+            'sort': sort,
+            'descending': descending}
+
+    def next_cursor(cursor):
+        return encode_cursor(cursor) if isinstance(cursor, tuple) else cursor
+
+    def int_arg(name):
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            abort(400)
+
+    def timestamp_arg(name):
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return datetime.utcfromtimestamp(float(value))
+        except (ValueError, OverflowError, OSError):
+            abort(400)
+
+    '''
+    actor_filters()
+        ?gender= and ?age_min= / ?age_max= (inclusive)
+    '''
+    def actor_filters():
+        filters = []
+        gender = request.args.get('gender')
+        if gender is not None:
+            filters.append(Actor.gender == gender)
+        age_min = int_arg('age_min')
+        if age_min is not None:
+            filters.append(Actor.age >= age_min)
+        age_max = int_arg('age_max')
+        if age_max is not None:
+            filters.append(Actor.age <= age_max)
+        return filters
+
+    '''
+    movie_filters()
+        ?title_prefix=, ?release_date_from= and ?release_date_to= (unix timestamps, inclusive)
+    '''
+    def movie_filters():
+        filters = []
+        title_prefix = request.args.get('title_prefix')
+        if title_prefix:
+            filters.append(Movie.title.startswith(title_prefix, autoescape=True))
+        start = timestamp_arg('release_date_from')
+        if start is not None:
+            filters.append(Movie.release_date >= start)
+        end = timestamp_arg('release_date_to')
+        if end is not None:
+            filters.append(Movie.release_date <= end)
+        return filters
+
+    def page_body(model, key, filters):
+        res, cursor = paginate(model, filters=filters, **page_args(model))
+        body = {'success': True, key: res, 'next': next_cursor(cursor)}
+        if request.args.get('total', 'true').lower() != 'false':
+            body['total_' + key] = row_counts.get(model, filters)
+        return body
+
+    '''
+    export(model)
+        streams every row of `model` as newline-delimited JSON,
+        gzip-compressed on the fly when the client accepts it
+    '''
+    def export(model):
+        rows = iter_rows(model, fields_arg(model), app.config['EXPORT_BATCH_SIZE'])
+        lines = (serialization.dumps(row) for row in rows)
+        headers = {'Vary': 'Accept-Encoding'}
+        if 'gzip' in request.accept_encodings:
+            headers['Content-Encoding'] = 'gzip'
+            lines = gzip_stream(lines, app.config['COMPRESS_GZIP_LEVEL'])
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers=headers)
+
+    '''
+    batch_ops(payload, permissions)
+        reads the {"create": [...], "update": [...], "delete": [...]} body of a
+        batch request, checking the permission of every operation it contains
+    '''
+    def batch_ops(payload, permissions):
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+        ops = {}
+        for op, permission in permissions.items():
+            items = body.get(op) or []
+            if not isinstance(items, list):
+                abort(400)
+            if items:
+                check_permissions(permission, payload)
+            ops[op] = items
+        return ops
+
+    def batch_chunk_size():
+        try:
+            chunk_size = int(request.args.get('chunk_size', app.config['BATCH_CHUNK_SIZE']))
+        except ValueError:
+            abort(400)
+        if chunk_size <= 0:
+            abort(400)
+        return chunk_size
+
+    def item_result(index, id=None, error=None):
+        if error is not None:
+            return {'index': index, 'success': False, 'error': error}
+        return {'index': index, 'success': True, 'id': id}
+
+    def is_id(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    REQUIRED_FIELDS = {Actor: 'name', Movie: 'title'}
+
+    '''
+    batch_row(model, item, partial)
+        the columns to write for one batch item, None when it is invalid.
+        With partial=True (updates) only the given columns are returned.
+    '''
+    def batch_row(model, item, partial):
+        if not isinstance(item, dict):
+            return None
+        row = {key: item[key] for key in model.FIELDS if key != 'id' and key in item}
+        if 'release_date' in row:
+            try:
+                row['release_date'] = datetime.utcfromtimestamp(row['release_date'])
+            except (TypeError, ValueError, OverflowError, OSError):
+                return None
+        for key, value in row.items():
+            # e.g. an int for age, text for name; null is left to the required check
+            expected = model.__table__.c[key].type.python_type
+            if value is not None and (not isinstance(value, expected) or isinstance(value, bool)):
+                return None
+        required = REQUIRED_FIELDS[model]
+        if row.get(required) is None and (required in row or not partial):
+            return None
+        return row
+
+    '''
+    patch(model, id)
+        writes the columns given in the PATCH body, and only them, while the
+        row still has one of the ETags of If-Match when the request sends it
+    '''
+    def patch(model, id):
+        values = batch_row(model, request.get_json(), partial=True)
+        if values is None:
+            abort(422)
+        versions = None
+        if request.if_match and not request.if_match.star_tag:
+            # If-Match compares strongly (RFC 7232 3.1): weak ETags, e.g. of a compressed body, never match
+            versions = [int(tag) for tag in request.if_match.as_set() if tag.isdigit()]
+            if not versions:
+                abort(412)
+        outcome, version = patch_row(model, id, values, versions)
+        if outcome == 'missing':
+            abort(404)
+        if outcome == 'conflict':
+            abort(412)
+        response = jsonify({"success": True, "edited": id})
+        response.set_etag(str(version))
+        return response
+
+    '''
+    get_row(model, id, key)
+        one row, with its version as ETag for If-None-Match and for the
+        If-Match of later PATCH requests
+    '''
+    def get_row(model, id, key):
+        row = db.session.query(*[getattr(model, field) for field in model.FIELDS], model.version) \
+            .filter(model.id==id).one_or_none()
+        if row is None:
+            abort(404)
+        response = jsonify({"success": True, key: dict(zip(model.FIELDS, row))})
+        response.set_etag(str(row.version))
+        return response.make_conditional(request)
+
+    '''
+    write_batch(model, ops)
+        validates every item, then writes all the valid ones with bulk
+        statements in a single transaction. Returns per-item results.
+    '''
+    def write_batch(model, ops):
+        chunk_size = batch_chunk_size()
+        created, edited, deleted = [], [], []
+
+        inserts = []
+        for index, item in enumerate(ops['create']):
+            row = batch_row(model, item, partial=False)
+            if row is None:
+                created.append(item_result(index, error=422))
+            else:
+                inserts.append((index, row))
+
+        updates = []
+        for index, item in enumerate(ops['update']):
+            row = batch_row(model, item, partial=True)
+            if row is None or not is_id(item.get('id')):
+                edited.append(item_result(index, error=422))
+            else:
+                row['id'] = item['id']
+                updates.append((index, row))
+
+        deletes = []
+        for index, id in enumerate(ops['delete']):
+            if is_id(id):
+                deletes.append((index, id))
+            else:
+                deleted.append(item_result(index, error=422))
+
+        found = existing_ids(model, [row['id'] for _, row in updates] + [id for _, id in deletes], chunk_size)
+        for index, row in [update for update in updates if update[1]['id'] not in found]:
+            edited.append(item_result(index, error=404))
+        updates = [update for update in updates if update[1]['id'] in found]
+        for index, id in [delete for delete in deletes if delete[1] not in found]:
+            deleted.append(item_result(index, error=404))
+        deletes = [delete for delete in deletes if delete[1] in found]
+
+        ids = bulk_insert(model, [row for _, row in inserts], chunk_size)
+        bulk_update(model, [row for _, row in updates], chunk_size)
+        bulk_delete(model, list({id for _, id in deletes}), chunk_size)
+        commit()
+
+        created += [item_result(index, id) for (index, _), id in zip(inserts, ids)]
+        edited += [item_result(index, row['id']) for index, row in updates]
+        deleted += [item_result(index, id) for index, id in deletes]
+        return {
+            'success': True,
+            'created': sorted(created, key=lambda result: result['index']),
+            'edited': sorted(edited, key=lambda result: result['index']),
+            'deleted': sorted(deleted, key=lambda result: result['index'])
+        }
+
+    @app.route('/actors:batch', methods=['POST'])
+    @requires_auth()
+    def batch_actors(payload):
+        ops = batch_ops(payload, {'create': 'post:actor', 'update': 'patch:actor', 'delete': 'delete:actor'})
+        return jsonify(write_batch(Actor, ops))
+
+    @app.route('/movies:batch', methods=['POST'])
+    @requires_auth()
+    def batch_movies(payload):
+        ops = batch_ops(payload, {'create': 'post:movie', 'update': 'patch:movie', 'delete': 'delete:movie'})
+        return jsonify(write_batch(Movie, ops))
+
+    @app.route('/movies/<int:movie_id>/actors:batch', methods=['POST'])
+    @requires_auth()
+    def batch_assign(payload, movie_id):
+        ops = batch_ops(payload, {'create': 'post:assign', 'delete': 'delete:assign'})
+        movie = Movie.query.get(movie_id)
+        if movie is None:
+            abort(404)
+        chunk_size = batch_chunk_size()
+        created, deleted = [], []
+
+        actor_ids = [id for id in ops['create'] + ops['delete'] if is_id(id)]
+        assigned = movie.assigns_of(actor_ids, chunk_size)
+        actors = existing_ids(Actor, [id for id in ops['create'] if is_id(id)], chunk_size)
+
+        inserts = []
+        pending = {}
+        for index, actor_id in enumerate(ops['create']):
+            if not is_id(actor_id):
+                created.append(item_result(index, error=422))
+            elif actor_id in assigned:
+                created.append(item_result(index, assigned[actor_id]))
+            elif actor_id not in actors:
+                created.append(item_result(index, error=404))
+            elif actor_id in pending:
+                pending[actor_id].append(index)
+            else:
+                pending[actor_id] = [index]
+                inserts.append({'movie_id': movie_id, 'actor_id': actor_id})
+
+        deletes = []
+        for index, actor_id in enumerate(ops['delete']):
+            if not is_id(actor_id):
+                deleted.append(item_result(index, error=422))
+            elif actor_id not in assigned:
+                deleted.append(item_result(index, error=404))
+            else:
+                deletes.append((index, assigned[actor_id]))
+
+        ids = bulk_insert(Assign, inserts, chunk_size)
+        bulk_delete(Assign, list({id for _, id in deletes}), chunk_size)
+        commit()
+
+        for row, id in zip(inserts, ids):
+            created += [item_result(index, id) for index in pending[row['actor_id']]]
+        deleted += [item_result(index, id) for index, id in deletes]
         return jsonify({
             'success': True,
-            'actors': res,
-            'total_actors': len(res)
+            'created': sorted(created, key=lambda result: result['index']),
+            'deleted': sorted(deleted, key=lambda result: result['index'])
         })
+
+    @app.route('/actors', methods=['GET'])
+    @cache.cached('Actor', assign_tag)
+    def get_actors():
+        return jsonify(page_body(Actor, 'actors', actor_filters()))
+
+    @app.route('/actors/export', methods=['GET'])
+    def export_actors():
+        return export(Actor)
     
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    def get_actor(actor_id):
+        return get_row(Actor, actor_id, 'actor')
+
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actor')
     def delete_actors(payload, actor_id):
-        actor = Actor.query.filter(Actor.id==actor_id).one_or_none()
-        if actor is None:
+        if not delete_row(Actor, actor_id):
             abort(404)
-        actor.delete()
         return jsonify({
                 "success": True,
                 "deleted": actor_id
@@ -46,6 +463,7 @@ def create_app(test_config=None):
     
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actor')
+    @idempotent
     def post_actors(payload):
         body = request.get_json()
         new_name = body.get("name", None)
@@ -67,38 +485,27 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actor')
     def patch_actors(payload, actor_id):
-        actor = Actor.query.filter(Actor.id==actor_id).one_or_none()
-        if actor is None:
-            abort(404)
-        body = request.get_json()
-        actor.name = body.get("name", None)
-        actor.age = body.get("age", None)
-        actor.gender = body.get("gender", None)
-        actor.update()
-        return jsonify(
-            {
-                "success": True,
-                "edited": actor.id
-            }
-        )
+        return patch(Actor, actor_id)
 
 
     @app.route('/movies', methods=['GET'])
+    @cache.cached('Movie', assign_tag, cast_tag)
     def get_movies():
-        res = [movie.format() for movie in Movie.query.all()]
-        return jsonify({
-            'success': True,
-            'movies': res,
-            'total_movies': len(res)
-        })
+        return jsonify(embed_casts(page_body(Movie, 'movies', movie_filters())))
+
+    @app.route('/movies/export', methods=['GET'])
+    def export_movies():
+        return export(Movie)
     
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    def get_movie(movie_id):
+        return get_row(Movie, movie_id, 'movie')
+
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movie')
     def delete_movies(payload, movie_id):
-        movie = Movie.query.filter(Movie.id==movie_id).one_or_none()
-        if movie is None:
+        if not delete_row(Movie, movie_id):
             abort(404)
-        movie.delete()
         return jsonify({
                 "success": True,
                 "deleted": movie_id
@@ -106,10 +513,11 @@ def create_app(test_config=None):
     
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movie')
+    @idempotent
     def post_movies(payload):
         body = request.get_json()
         new_title = body.get("title", None)
-        new_relase_date = datetime.utcfromtimestamp(body.get("release_date", None)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        new_relase_date = datetime.utcfromtimestamp(body.get("release_date", None))
         if new_title is None:
             abort(422)
         
@@ -126,23 +534,12 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movie')
     def patch_movies(payload, movie_id):
-        movie = Movie.query.filter(Movie.id==movie_id).one_or_none()
-        if movie is None:
-            abort(404)
-        body = request.get_json()
-        movie.title = body.get("title", None)
-        movie.release_date = datetime.utcfromtimestamp(body.get("release_date", None)).strftime('%Y-%m-%dT%H:%M:%SZ')
-        movie.update()
-        return jsonify(
-            {
-                "success": True,
-                "edited": movie.id
-            }
-        )
+        return patch(Movie, movie_id)
 
     @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @cache.cached('Movie:{movie_id}', 'Actor')
     def get_actors_by_movie(movie_id):
-        movie = Movie.query.filter(Movie.id==movie_id).one_or_none()
+        movie = Movie.with_actors(movie_id, app.config['CAST_LOADING_STRATEGY'])
         if movie is None:
             abort(404)
         res = [actor.format() for actor in movie.actors]
@@ -154,36 +551,101 @@ def create_app(test_config=None):
             }
         )
     
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @cache.cached('Movie', 'Actor:{actor_id}', assign_tag, cast_tag)
+    def get_movies_by_actor(actor_id):
+        args = page_args(Movie)
+        scope = Movie.of_actor(actor_id)
+        res, cursor = paginate(Movie, filters=scope['filters'] + movie_filters(), join=scope['join'], **args)
+        # an empty first page may mean there is no such actor
+        if not res and args['after'] is None and Actor.query.get(actor_id) is None:
+            abort(404)
+        return jsonify(embed_casts(
+            {
+                "success": True,
+                "movies": res,
+                "next": next_cursor(cursor)
+            }
+        ))
+
+    SEARCHABLE = {'actors': Actor, 'movies': Movie}
+
+    '''
+    search_rows()
+        GET /search?q=<text> ranks the actors and movies whose name / title
+        has words starting with every word of q. Optional `type` (actors or
+        movies, both by default), `limit` (default SEARCH_LIMIT) and
+        `offset` (the `next` value of the previous page).
+    '''
+    @app.route('/search', methods=['GET'])
+    @cache.cached('Actor', 'Movie')
+    def search_rows():
+        text = request.args.get('q', '').strip()
+        types = request.args.get('type')
+        types = types.split(',') if types else list(SEARCHABLE)
+        if not text or not set(types) <= set(SEARCHABLE):
+            abort(400)
+        try:
+            limit = int(request.args.get('limit', app.config['SEARCH_LIMIT']))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            abort(400)
+        if limit <= 0 or offset < 0:
+            abort(400)
+        limit = min(limit, app.config['MAX_PAGE_SIZE'])
+        body = {'success': True, 'next': None}
+        for key in types:
+            body[key], more = search(SEARCHABLE[key], text, limit, offset)
+            if more:
+                body['next'] = offset + limit
+        return jsonify(body)
+
+    '''
+    get_changes()
+        the inserts, updates and deletes of actors, movies and assigns
+        after ?since= (the `next` value of the previous call), for mirrors
+        to sync incrementally. Never cached: `next` moves with every write.
+    '''
+    @app.route('/changes', methods=['GET'])
+    def get_changes():
+        since = request.args.get('since')
+        try:
+            limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+            after = decode_cursor(Change, 'txid', since) if since else None
+        except ValueError:
+            abort(400)
+        if limit <= 0 or (after is not None and not isinstance(after[0], int)):
+            abort(400)
+        changes, cursor, more = changes_since(after, min(limit, app.config['MAX_PAGE_SIZE']))
+        return jsonify(
+            {
+                "success": True,
+                "changes": changes,
+                "next": encode_cursor(cursor) if cursor is not None else None,
+                "more": more
+            }
+        )
+
     @app.route("/movies/<int:movie_id>/actors/<int:actor_id>", methods=['POST'])
     @requires_auth('post:assign')
+    @idempotent
     def assign_actor_to_movie(payload, movie_id, actor_id):
-        print("moive_id = ", movie_id)
-        print("actor_id = ", actor_id)
-        movie = Movie.query.filter(Movie.id==movie_id).one_or_none()
-        if movie is None:
-            abort(404)
-        print("get movie")
-        actor = Actor.query.filter(Actor.id==actor_id).one_or_none()
-        if actor is None:
+        assign_id = Assign.link(movie_id, actor_id)
+        if assign_id is None:
             abort(404)
-        print("get actor")
-        assign = Assign(movie_id=movie_id, actor_id=actor_id)
-        assign.insert()
         return jsonify(
             {
                 "success": True,
-                "created": assign.id
+                "created": assign_id
             }
         )
 
     @app.route("/movies/<int:movie_id>/actors/<int:actor_id>", methods=['DELETE'])
     @requires_auth('delete:assign')
     def remove_actor_from_movie(payload, movie_id, actor_id):
-        assign = Assign.query.filter(Assign.movie_id==movie_id).filter(Assign.actor_id==actor_id).one_or_none()
-        if assign is None:
+        assign_id = Assign.unlink(movie_id, actor_id)
+        if assign_id is None:
             abort(404)
-        assign_id = assign.id
-        assign.delete()
         return jsonify(
             {
                 "success": True,
@@ -203,10 +665,46 @@ def create_app(test_config=None):
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({"success": False, "error": 400, "message": "bad request"}), 400
+
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({"success": False, "error": 409, "message": "conflict"}), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({"success": False, "error": 412, "message": "precondition failed"}), 412
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({"success": False, "error": 429, "message": "too many requests"}), 429, \
+            {'Retry-After': str(error.retry_after)}
+
+    @app.errorhandler(AuthError)
+    def auth_error(error):
+        return jsonify({"success": False, "error": error.status_code, "message": error.error['description']}), error.status_code
     
 
     return app
 
+def cache_gauges(app):
+    values = {}
+    for name, value in token_cache.stats().items():
+        values[('token_cache_' + name, ())] = value
+    for name, value in app.extensions['response_cache'].stats().items():
+        values[('response_cache_' + name, ())] = value
+    for bind, stats in pool_stats(app).items():
+        for name, value in stats.items():
+            values[('db_pool_' + name, (('bind', bind),))] = value
+    return values
+
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 app = create_app()
 
 if __name__ == '__main__':
@@ -1,12 +1,42 @@
-import json
-from flask import request, _request_ctx_stack, request, abort
+import os
+import time
+from flask import request, _request_ctx_stack, request, abort, current_app, g
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from .jwks import JWKSStore
+from .token_cache import VerifiedTokenCache
 
 AUTH0_DOMAIN = 'dev-dlnuifd3dyihlhyz.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone'
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+'''
+jwks_store
+    signing keys of AUTH0_DOMAIN, cached in-process.
+    JWKS_SOURCE may point to another URL or to a local JWKS file.
+'''
+jwks_store = JWKSStore(
+    os.environ.get('JWKS_SOURCE', JWKS_URL),
+    ttl=int(os.environ.get('JWKS_TTL', 3600)))
+
+
+def set_jwks_source(source, ttl=None):
+    """Replaces where the signing keys come from (URL, file path or callable)
+    """
+    jwks_store.source = source
+    if ttl is not None:
+        jwks_store.ttl = ttl
+    jwks_store.clear()
+    token_cache.clear()
+
+
+'''
+token_cache
+    payloads of tokens that already passed verify_decode_jwt,
+    kept until their `exp`. TOKEN_CACHE_SIZE=0 disables it.
+'''
+token_cache = VerifiedTokenCache(int(os.environ.get('TOKEN_CACHE_SIZE', 1024)))
 
 ## AuthError Exception
 '''
@@ -70,8 +100,10 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -80,15 +112,15 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = jwks_store.get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -99,6 +131,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            token_cache.put(token, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -127,14 +160,32 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
+            limiter = current_app.extensions.get('ratelimit')
+            start = time.perf_counter()
             try:
-                payload = verify_decode_jwt(token)
-            except:
-                abort(401)
-            
-            check_permissions(permission, payload)
+                token = get_token_auth_header()
+                try:
+                    payload = verify_decode_jwt(token)
+                except:
+                    abort(401)
+            except Exception:
+                # no valid token: limited per address, like the public routes
+                if limiter is not None:
+                    limiter.check_address()
+                raise
+            finally:
+                g.auth_seconds = g.get('auth_seconds', 0.0) + time.perf_counter() - start
+
+            # limited per token subject, see ratelimit.before_request
+            if limiter is not None:
+                limiter.check('sub:' + str(payload.get('sub')))
+
+            # without a permission any valid token is enough,
+            # the handler checks what it needs with check_permissions
+            if permission:
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
+        wrapper.requires_auth = True
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+
+'''
+JWKSStore
+Keeps the identity provider's signing keys in memory so that
+verifying a token does not cost a round trip to the provider.
+
+`source` may be an URL, the path of a local JWKS file or a callable
+returning the JWKS document (handy for tests and air-gapped runs).
+Keys older than `ttl` seconds are refreshed in a background thread
+while the cached ones keep being served; an unknown `kid` triggers
+one synchronous re-fetch, at most every `min_refresh_interval` seconds.
+'''
+class JWKSStore:
+    def __init__(self, source, ttl=3600, min_refresh_interval=30, timeout=5):
+        self.source = source
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.RLock()
+
+    def load(self):
+        source = self.source
+        if callable(source):
+            return source()
+        if source.startswith(('http://', 'https://')):
+            with urlopen(source, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        with open(source) as f:
+            return json.load(f)
+
+    def refresh(self):
+        with self._fetch_lock:
+            self._last_attempt = time.monotonic()
+            jwks = self.load()
+            keys = {key['kid']: key for key in jwks.get('keys', []) if 'kid' in key}
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = time.monotonic()
+            return keys
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving the keys we already have
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def is_stale(self):
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    def get_key(self, kid):
+        if self._fetched_at is None:
+            with self._fetch_lock:
+                if self._fetched_at is None:
+                    self.refresh()
+        elif self.is_stale():
+            self.refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._last_attempt >= self.min_refresh_interval:
+            key = self.refresh().get(kid)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
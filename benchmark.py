@@ -0,0 +1,382 @@
+"""Load test of every endpoint of create_app
+
+Builds the app against a local database (in-memory SQLite by default),
+seeds a catalog, mints tokens with a local RSA key served by a stubbed
+JWKS, then times every route and writes throughput and p50/p95/p99
+latencies as JSON:
+
+    python benchmark.py --actors 5000 --movies 1000 --cast 20 --output bench.json
+    python benchmark.py --database postgresql://localhost/capstone_bench --reset
+    python benchmark.py --compare bench.json
+
+With --compare the run fails (exit status 1) when the p95 latency of a
+route, or a boot time, grew more than --threshold percent over the
+saved results.
+
+Boot times are measured in fresh interpreters: `import_ms` is what a
+gunicorn worker pays to import app:app, `create_app_ms` what every
+test pays for its app, `first_request_ms` the first request served.
+
+Every route also reports its commits per request, and a request writing
+a movie and its cast through the model methods is timed with a commit
+per write and with the unit of work (--unit-of-work-rows).
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('EXCITED', 'true')
+
+from app import create_app
+from auth.testing import LocalSigner
+from models import db, bulk_insert, Actor, Movie, Assign
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PERMISSIONS = [
+    'post:actor', 'patch:actor', 'delete:actor',
+    'post:movie', 'patch:movie', 'delete:movie',
+    'post:assign', 'delete:assign']
+
+# routes that are not worth timing
+SKIPPED_RULES = {'/static/<path:filename>'}
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Bench:
+    def __init__(self, app, signer):
+        self.app = app
+        self.client = app.test_client()
+        self.headers = signer.headers(PERMISSIONS, expires_in=24 * 3600)
+        self.actors = self.movies = 0
+        self.commits = 0
+
+    def seed(self, actors, movies, cast):
+        with self.app.app_context():
+            ids = bulk_insert(Actor, [
+                {'name': 'actor {}'.format(i), 'age': 18 + i % 60, 'gender': ('female', 'male')[i % 2]}
+                for i in range(actors)])
+            movie_ids = bulk_insert(Movie, [
+                {'title': 'movie {}'.format(i), 'release_date': datetime(1950 + i % 75, 1 + i % 12, 1)}
+                for i in range(movies)])
+            cast = min(cast, len(ids))
+            bulk_insert(Assign, [
+                {'movie_id': movie_id, 'actor_id': ids[(n * cast + k) % len(ids)]}
+                for n, movie_id in enumerate(movie_ids) for k in range(cast)])
+            db.session.commit()
+        self.actors, self.movies = actors, movies
+
+    # untimed helpers creating the rows destructive requests work on
+    def new_actor(self):
+        with self.app.app_context():
+            actor = Actor(name='bench', age=30, gender='female')
+            actor.insert()
+            return actor.id
+
+    def new_movie(self):
+        with self.app.app_context():
+            movie = Movie(title='bench', release_date=datetime(2020, 1, 1))
+            movie.insert()
+            return movie.id
+
+    def new_assign(self, movie_id=1):
+        actor_id = self.new_actor()
+        with self.app.app_context():
+            Assign(movie_id=movie_id, actor_id=actor_id).insert()
+        return actor_id
+
+    def actor_id(self, i):
+        return 1 + i % max(self.actors, 1)
+
+    def movie_id(self, i):
+        return 1 + i % max(self.movies, 1)
+
+    '''
+    scenarios()
+        '<METHOD> <rule>' -> function of the iteration number returning
+        the (method, path, json body) of the request to time
+    '''
+    def scenarios(self):
+        batch = [{'name': 'batch', 'age': 30, 'gender': 'male'} for _ in range(100)]
+        return {
+            'GET /': lambda i: ('GET', '/', None),
+            'GET /coolkids': lambda i: ('GET', '/coolkids', None),
+            'GET /metrics': lambda i: ('GET', '/metrics', None),
+            'GET /actors': lambda i: ('GET', '/actors', None),
+            'GET /movies': lambda i: ('GET', '/movies', None),
+            'GET /actors/export': lambda i: ('GET', '/actors/export', None),
+            'GET /movies/export': lambda i: ('GET', '/movies/export', None),
+            'GET /changes': lambda i: ('GET', '/changes', None),
+            'GET /search': lambda i: ('GET', '/search?q={}'.format(('act', 'movie 1', 'mo')[i % 3]), None),
+            'GET /movies/<int:movie_id>/actors':
+                lambda i: ('GET', '/movies/{}/actors'.format(self.movie_id(i)), None),
+            'GET /actors/<int:actor_id>/movies':
+                lambda i: ('GET', '/actors/{}/movies'.format(self.actor_id(i)), None),
+            'GET /actors/<int:actor_id>': lambda i: ('GET', '/actors/{}'.format(self.actor_id(i)), None),
+            'GET /movies/<int:movie_id>': lambda i: ('GET', '/movies/{}'.format(self.movie_id(i)), None),
+            'POST /actors': lambda i: ('POST', '/actors', {'name': 'bench', 'age': 30, 'gender': 'male'}),
+            'PATCH /actors/<int:actor_id>':
+                lambda i: ('PATCH', '/actors/{}'.format(self.actor_id(i)), {'name': 'bench', 'age': 31, 'gender': 'male'}),
+            'DELETE /actors/<int:actor_id>':
+                lambda i: ('DELETE', '/actors/{}'.format(self.new_actor()), None),
+            'POST /movies': lambda i: ('POST', '/movies', {'title': 'bench', 'release_date': 1625112900}),
+            'PATCH /movies/<int:movie_id>':
+                lambda i: ('PATCH', '/movies/{}'.format(self.movie_id(i)), {'title': 'bench', 'release_date': 1625112900}),
+            'DELETE /movies/<int:movie_id>':
+                lambda i: ('DELETE', '/movies/{}'.format(self.new_movie()), None),
+            'POST /movies/<int:movie_id>/actors/<int:actor_id>':
+                lambda i: ('POST', '/movies/1/actors/{}'.format(self.new_actor()), None),
+            'DELETE /movies/<int:movie_id>/actors/<int:actor_id>':
+                lambda i: ('DELETE', '/movies/1/actors/{}'.format(self.new_assign()), None),
+            'POST /actors:batch': lambda i: ('POST', '/actors:batch', {'create': batch}),
+            'POST /movies:batch':
+                lambda i: ('POST', '/movies:batch', {'create': [{'title': 'batch', 'release_date': 1625112900}] * 100}),
+            'POST /movies/<int:movie_id>/actors:batch':
+                lambda i: ('POST', '/movies/1/actors:batch', {'create': [self.new_actor() for _ in range(10)]}),
+        }
+
+    def routes(self):
+        return sorted(
+            '{} {}'.format(method, rule.rule)
+            for rule in self.app.url_map.iter_rules() if rule.rule not in SKIPPED_RULES
+            for method in rule.methods - {'HEAD', 'OPTIONS'})
+
+    def count_commit(self, conn):
+        self.commits += 1
+
+    def time_route(self, scenario, requests, warmup):
+        latencies = []
+        errors = 0
+        commits = 0
+        for i in range(warmup + requests):
+            method, path, body = scenario(i)
+            before = self.commits
+            start = time.perf_counter()
+            response = self.client.open(path, method=method, json=body, headers=self.headers)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            if i < warmup:
+                continue
+            latencies.append(elapsed)
+            commits += self.commits - before
+            if response.status_code >= 400:
+                errors += 1
+        latencies.sort()
+        total = sum(latencies)
+        return {
+            'requests': requests,
+            'errors': errors,
+            'throughput_rps': requests / total if total else None,
+            'mean_ms': 1000 * total / requests,
+            'p50_ms': 1000 * percentile(latencies, 0.50),
+            'p95_ms': 1000 * percentile(latencies, 0.95),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'commits_per_request': commits / requests}
+
+    def run(self, requests=200, warmup=10, only=None):
+        scenarios = self.scenarios()
+        missing = [route for route in self.routes() if route not in scenarios]
+        results = {}
+        event.listen(Engine, 'commit', self.count_commit)
+        try:
+            for route in self.routes():
+                if route in missing or (only and only not in route):
+                    continue
+                results[route] = self.time_route(scenarios[route], requests, warmup)
+        finally:
+            event.remove(Engine, 'commit', self.count_commit)
+        return results, missing
+
+
+BOOT_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+application.test_client().get('/')
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': 1000 * (imported - start),
+    'create_app_ms': 1000 * (created - imported),
+    'first_request_ms': 1000 * (served - created)}))
+"""
+
+
+def boot(database='sqlite://', runs=5):
+    """Median boot times of `runs` fresh interpreters"""
+    env = dict(os.environ, DATABASE_URL=database)
+    samples = [
+        json.loads(subprocess.run([sys.executable, '-c', BOOT_SCRIPT], env=env, check=True,
+                                  stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__))).stdout)
+        for _ in range(runs)]
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+'''
+unit_of_work(database, rows, requests)
+    commits and mean time of a request creating a movie and a cast of
+    `rows` actors through the model methods, each write committed on its
+    own (UNIT_OF_WORK=false) and all of them staged in one unit of work
+'''
+def unit_of_work(database='sqlite://', rows=10, requests=50):
+    results = {}
+    for mode, staged in (('per_write', False), ('unit_of_work', True)):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': database, 'UNIT_OF_WORK': staged, 'RATE_LIMIT_URL': 'none'})
+
+        @app.route('/benchmark/cast', methods=['POST'])
+        def create_cast():
+            movie = Movie(title='bench', release_date=datetime(2021, 7, 1))
+            movie.insert()
+            for _ in range(rows):
+                actor = Actor(name='bench', age=30, gender='male')
+                actor.insert()
+                Assign(movie_id=movie.id, actor_id=actor.id).insert()
+            return '', 204
+
+        client = app.test_client()
+        commits = [0]
+
+        def count_commit(conn):
+            commits[0] += 1
+        event.listen(Engine, 'commit', count_commit)
+        try:
+            start = time.perf_counter()
+            for _ in range(requests):
+                client.post('/benchmark/cast')
+            elapsed = time.perf_counter() - start
+        finally:
+            event.remove(Engine, 'commit', count_commit)
+        results[mode] = {'commits_per_request': commits[0] / requests, 'mean_ms': 1000 * elapsed / requests}
+    return results
+
+
+def compare_boot(times, baseline, threshold):
+    """Boot times that grew more than `threshold` percent"""
+    regressions = []
+    for key, after in times.items():
+        before = baseline.get('boot', {}).get(key)
+        if before and after > before * (1 + threshold / 100):
+            regressions.append(('boot ' + key, before, after))
+    return regressions
+
+
+def compare(results, baseline, threshold):
+    """Routes whose p95 latency grew more than `threshold` percent"""
+    regressions = []
+    for route, result in results.items():
+        before = baseline.get('routes', {}).get(route)
+        if before and before['p95_ms'] and result['p95_ms'] > before['p95_ms'] * (1 + threshold / 100):
+            regressions.append((route, before['p95_ms'], result['p95_ms']))
+    return regressions
+
+
+def run(database='sqlite://', actors=1000, movies=200, cast=10, requests=200, warmup=10,
+        reset=False, only=None, config=None, signer=None):
+    signer = signer or LocalSigner()
+    # the load test is one client sending as fast as it can
+    app_config = {'SQLALCHEMY_DATABASE_URI': database, 'JWKS_SOURCE': signer.load_jwks, 'RATE_LIMIT_URL': 'none'}
+    app_config.update(config or {})
+    app = create_app(app_config)
+    if reset:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+    bench = Bench(app, signer)
+    bench.seed(actors, movies, cast)
+    results, missing = bench.run(requests, warmup, only)
+    return {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+            'actors': actors,
+            'movies': movies,
+            'cast': cast,
+            'requests': requests,
+            'untimed_routes': missing},
+        'routes': results}
+
+
+def parse_config(pairs):
+    config = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        config[key] = int(value) if value.isdigit() else value
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every endpoint of the app.')
+    parser.add_argument('--database', default='sqlite://', help='database URL (default: in-memory SQLite)')
+    parser.add_argument('--reset', action='store_true', help='drop and re-create the tables before seeding')
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=200)
+    parser.add_argument('--cast', type=int, default=10, help='actors assigned to every movie')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per route')
+    parser.add_argument('--only', help='only time the routes containing this text')
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='app config override, e.g. --config RESPONSE_CACHE_URL=none')
+    parser.add_argument('--boot-runs', type=int, default=5, help='interpreters started to time the boot (0: skip)')
+    parser.add_argument('--unit-of-work-rows', type=int, default=10,
+                        help='actors of the request comparing commits per write with the unit of work (0: skip)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of earlier results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=20, help='allowed p95 growth in percent')
+    args = parser.parse_args(argv)
+
+    report = run(args.database, args.actors, args.movies, args.cast, args.requests, args.warmup,
+                 args.reset, args.only, parse_config(args.config))
+    if args.boot_runs:
+        report['boot'] = boot(args.database, args.boot_runs)
+    if args.unit_of_work_rows:
+        report['unit_of_work'] = unit_of_work(args.database, args.unit_of_work_rows)
+
+    print('{:<55} {:>9} {:>9} {:>9} {:>9} {:>8} {:>6}'.format(
+        'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'commits', 'errors'))
+    for route, result in report['routes'].items():
+        print('{:<55} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.2f} {:>6}'.format(
+            route, result['throughput_rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['commits_per_request'], result['errors']))
+    for route in report['meta']['untimed_routes']:
+        print('no scenario for {}'.format(route))
+    for key, value in report.get('boot', {}).items():
+        print('boot {:<50} {:>9.2f} ms'.format(key, value))
+    for mode, result in report.get('unit_of_work', {}).items():
+        print('{:<55} {:>9.2f} ms {:>8.2f} commits'.format(
+            'POST of a cast, ' + mode.replace('_', ' '), result['mean_ms'], result['commits_per_request']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report['routes'], baseline, args.threshold) + \
+            compare_boot(report.get('boot', {}), baseline, args.threshold)
+        for route, before, after in regressions:
+            print('REGRESSION {}: {:.2f} ms -> {:.2f} ms'.format(route, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, make_response, request
+
+from serialization import pack, response_mimetype, unpack
+
+
+'''
+LocalBackend
+In-process LRU of `maxsize` entries. Tag versions are kept apart from
+the entries so that they are never evicted.
+'''
+class LocalBackend:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def versions(self, tags):
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+'''
+SharedBackend
+Entries and tag versions live in a store shared by every worker.
+`client` is anything with the get/set(ex=)/mget/incr methods of a
+redis.Redis client, e.g. redis.Redis.from_url(RESPONSE_CACHE_URL)
+or a local stand-in with the same methods.
+'''
+class SharedBackend:
+    def __init__(self, client, prefix='capstone:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        try:
+            return unpack(value)
+        except ValueError:
+            # e.g. left by an older release: a miss
+            return None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pack(value), ex=max(1, int(ttl)))
+
+    def versions(self, tags):
+        if not tags:
+            return []
+        values = self.client.mget([self.prefix + 'tag:' + tag for tag in tags])
+        return [int(value or 0) for value in values]
+
+    def bump(self, tags):
+        for tag in tags:
+            self.client.incr(self.prefix + 'tag:' + tag)
+
+
+'''
+ResponseCache
+Caches the body of successful GET responses. Every entry depends on
+tags (e.g. 'Actor', 'Movie:1'); the current version of each tag is
+part of the cache key, so bumping a tag after a write makes every
+entry depending on it unreachable at once, in every worker sharing
+the backend.
+'''
+class ResponseCache:
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None and self.ttl > 0
+
+    def key(self, path, tags):
+        versions = self.backend.versions(tags)
+        raw = '{}|{}'.format(path, ','.join('{}={}'.format(*pair) for pair in zip(tags, versions)))
+        return 'response:' + hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, entry):
+        self.backend.set(key, entry, self.ttl)
+
+    def invalidate(self, *tags):
+        if self.backend is not None and tags:
+            self.backend.bump(sorted(set(tags)))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def make_backend(url, maxsize=1024):
+    if not url or url == 'none':
+        return None
+    if url == 'local':
+        return LocalBackend(maxsize)
+    import redis
+    return SharedBackend(redis.Redis.from_url(url))
+
+
+def init_app(app, backend=None):
+    """Attaches a ResponseCache configured by RESPONSE_CACHE_URL/SIZE/TTL to the app
+    """
+    if backend is None:
+        backend = make_backend(app.config['RESPONSE_CACHE_URL'], app.config['RESPONSE_CACHE_SIZE'])
+    app.extensions['response_cache'] = ResponseCache(backend, app.config['RESPONSE_CACHE_TTL'])
+    return app.extensions['response_cache']
+
+
+def invalidate(*tags):
+    """Drops the cached responses depending on `tags` in the current app
+    """
+    cache = current_app.extensions.get('response_cache') if current_app else None
+    if cache is not None:
+        cache.invalidate(*tags)
+
+
+def etag_of(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+'''
+cached(*tags)
+    caches the 200 responses of a GET view under tags formatted with the
+    view arguments, e.g. @cached('Movie:{movie_id}'). A tag may also be a
+    function of the view arguments, returning None when the request does
+    not depend on it. Every response gets a strong ETag so clients can
+    revalidate with If-None-Match. A miss runs the view against the
+    primary database, never a lagging read replica.
+'''
+def cached(*tags):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(**kwargs):
+            cache = current_app.extensions.get('response_cache')
+            key = entry = None
+            if cache is not None and cache.enabled:
+                path = '{} {}'.format(response_mimetype(), request.full_path)
+                names = [tag(**kwargs) if callable(tag) else tag.format(**kwargs) for tag in tags]
+                key = cache.key(path, [name for name in names if name is not None])
+                entry = cache.get(key)
+            if entry is None:
+                if key is not None:
+                    # what is stored under the new tag versions must not lag behind the
+                    # write that bumped them: fills read the primary, not the replica
+                    g.read_from_primary = True
+                response = make_response(f(**kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                entry = {'body': body, 'mimetype': response.mimetype, 'etag': etag_of(body)}
+                if key is not None:
+                    cache.set(key, entry)
+            response = current_app.response_class(entry['body'], mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            return response.make_conditional(request)
+
+        return wrapper
+    return cached_decorator
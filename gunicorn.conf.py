@@ -0,0 +1,21 @@
+"""Gunicorn settings, read by `gunicorn app:app` (see Procfile)
+
+WORKER_CLASS=gevent serves each worker with greenlets instead of one
+request at a time: waiting on PostgreSQL, Redis or the JWKS endpoint
+yields to the other requests of the worker, so a worker keeps up to
+WORKER_CONNECTIONS connections open. The routes and the models are the
+same in both modes. Gunicorn still reads PORT and WEB_CONCURRENCY.
+"""
+import os
+
+worker_class = os.environ.get('WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('WORKER_TIMEOUT', 30))
+
+
+def post_fork(server, worker):
+    # psycopg2 waits for the database in C; make it wait on the gevent hub
+    postgres = os.environ.get('DATABASE_URL', '').startswith('postgres')
+    if postgres and 'gevent' in server.cfg.worker_class_str:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
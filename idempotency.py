@@ -0,0 +1,200 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import abort, current_app, make_response, request
+
+from models import after_commit
+from serialization import pack, unpack
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+'''
+LocalStore
+In-process LRU of at most `maxsize` stored responses, each dropped
+`ttl` seconds after it was stored. Requests running under a key are
+tracked apart, with an event the duplicates arriving meanwhile wait on.
+'''
+class LocalStore:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def claim(self, key):
+        """('done', stored value), ('run', None) for the first request or ('wait', None)"""
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                return 'done', value
+            if key in self._running:
+                return 'wait', None
+            self._running[key] = threading.Event()
+            return 'run', None
+
+    def wait(self, key, timeout):
+        with self._lock:
+            running = self._running.get(key)
+        if running is not None:
+            running.wait(timeout)
+
+    def store(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._release(key)
+
+    def release(self, key):
+        with self._lock:
+            self._release(key)
+
+    def _release(self, key):
+        running = self._running.pop(key, None)
+        if running is not None:
+            running.set()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+'''
+SharedStore
+Stored responses live in a store shared by every worker. `client` is
+anything with the get/set(ex=, nx=)/delete methods of a redis.Redis
+client. The first request under a key holds a lock entry, which expires
+by itself should its worker die; duplicates poll until it is gone.
+'''
+class SharedStore:
+    def __init__(self, client, prefix='capstone:idempotency:', lock_ttl=60, poll_interval=0.05):
+        self.client = client
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        try:
+            return unpack(value)
+        except ValueError:
+            return None
+
+    def claim(self, key):
+        value = self.get(key)
+        if value is not None:
+            return 'done', value
+        if self.client.set(self.prefix + 'lock:' + key, 1, ex=self.lock_ttl, nx=True):
+            return 'run', None
+        return 'wait', None
+
+    def wait(self, key, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.client.get(self.prefix + 'lock:' + key) is not None:
+            time.sleep(self.poll_interval)
+
+    def store(self, key, value, ttl):
+        self.client.set(self.prefix + key, pack(value), ex=max(1, int(ttl)))
+        self.release(key)
+
+    def release(self, key):
+        self.client.delete(self.prefix + 'lock:' + key)
+
+
+def make_store(url, maxsize=10000):
+    if not url or url == 'none':
+        return None
+    if url == 'local':
+        return LocalStore(maxsize)
+    import redis
+    return SharedStore(redis.Redis.from_url(url))
+
+
+def init_app(app, store=None):
+    """Attaches the store configured by IDEMPOTENCY_URL/SIZE to the app
+    """
+    if store is None:
+        store = make_store(app.config['IDEMPOTENCY_URL'], app.config['IDEMPOTENCY_SIZE'])
+    app.extensions['idempotency'] = store
+    return store
+
+
+def fingerprint():
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+
+'''
+idempotent(f)
+    for views behind requires_auth: a request with an Idempotency-Key
+    header runs once per key and token subject. Retries get the stored
+    response back, marked with Idempotent-Replayed, while it lives
+    (IDEMPOTENCY_TTL); retries arriving while it runs wait for it.
+    Reusing a key for another request body is a 422.
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        store = current_app.extensions.get('idempotency')
+        idempotency_key = request.headers.get(HEADER)
+        if store is None or idempotency_key is None:
+            return f(payload, *args, **kwargs)
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            abort(400)
+        raw = '\n'.join([str(payload.get('sub')), request.method, request.path, idempotency_key])
+        key = hashlib.sha256(raw.encode()).hexdigest()
+        ttl = current_app.config['IDEMPOTENCY_TTL']
+
+        deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT']
+        while True:
+            state, entry = store.claim(key)
+            if state != 'wait':
+                break
+            if time.monotonic() >= deadline:
+                # the first request is still running: let the client retry later
+                abort(409)
+            store.wait(key, deadline - time.monotonic())
+
+        if state == 'done':
+            if entry['fingerprint'] != fingerprint():
+                abort(422)
+            response = current_app.response_class(entry['body'], status=entry['status'], mimetype=entry['mimetype'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except BaseException:
+            store.release(key)
+            raise
+        if 200 <= response.status_code < 300 and not response.is_streamed:
+            entry = {
+                'fingerprint': fingerprint(),
+                'status': response.status_code,
+                'mimetype': response.mimetype,
+                'body': response.get_data()}
+            # replayed only once what it reports is committed
+            after_commit(lambda: store.store(key, entry, ttl), lambda: store.release(key))
+        else:
+            # failures are not stored: a retry runs the request again
+            store.release(key)
+        return response
+
+    return wrapper
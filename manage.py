@@ -1,10 +1,14 @@
+import os
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
 
-migrate = Migrate(app, db)
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+migrate = Migrate(app, db, directory=MIGRATIONS_DIR)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('capstone.sql')
+
+# upper bounds, in seconds, of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+'''
+RouteStats
+Totals of one method + route: request count per status, a duration
+histogram, the time spent in auth and in the database, and the
+transactions committed.
+'''
+class RouteStats:
+    def __init__(self):
+        self.statuses = defaultdict(int)
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.auth_seconds = 0.0
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.db_commits = 0
+        self.response_bytes = 0
+
+    def observe(self, status, seconds, auth_seconds, db_seconds, db_queries, db_commits, response_bytes):
+        self.statuses[status] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.auth_seconds += auth_seconds
+        self.db_seconds += db_seconds
+        self.db_queries += db_queries
+        self.db_commits += db_commits
+        self.response_bytes += response_bytes
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.routes = defaultdict(RouteStats)
+        self.gauges = []
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, *values):
+        with self._lock:
+            self.routes[(method, route)].observe(*values)
+
+    def add_gauges(self, collect):
+        """`collect()` returns {(metric name, ((label, value), ...)): number} to export"""
+        self.gauges.append(collect)
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        with self._lock:
+            routes = sorted(self.routes.items())
+
+            metric('http_requests_total', 'counter', 'Requests per route and status.')
+            for (method, route), stats in routes:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append('http_requests_total{{{},status="{}"}} {}'.format(labels(method, route), status, count))
+
+            metric('http_request_duration_seconds', 'histogram', 'Time spent handling requests.')
+            for (method, route), stats in routes:
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    lines.append('http_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels(method, route), bound, count))
+                lines.append('http_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels(method, route), stats.count))
+                lines.append('http_request_duration_seconds_sum{{{}}} {}'.format(labels(method, route), stats.seconds))
+                lines.append('http_request_duration_seconds_count{{{}}} {}'.format(labels(method, route), stats.count))
+
+            for name, attribute, help_text in (
+                    ('http_request_auth_seconds_total', 'auth_seconds', 'Time spent verifying tokens.'),
+                    ('http_request_db_seconds_total', 'db_seconds', 'Time spent running SQL statements.'),
+                    ('http_request_db_queries_total', 'db_queries', 'SQL statements run.'),
+                    ('http_request_db_commits_total', 'db_commits', 'Transactions committed.'),
+                    ('http_response_bytes_total', 'response_bytes', 'Size of the response bodies.')):
+                metric(name, 'counter', help_text)
+                for (method, route), stats in routes:
+                    lines.append('{}{{{}}} {}'.format(name, labels(method, route), getattr(stats, attribute)))
+
+        values = {}
+        for collect in self.gauges:
+            values.update(collect())
+        for name in sorted({name for name, _ in values}):
+            metric(name, 'gauge', name.replace('_', ' ') + '.')
+            for (other, label_pairs), value in sorted(values.items()):
+                if other == name:
+                    text = ','.join('{}="{}"'.format(*pair) for pair in label_pairs)
+                    lines.append('{}{{{}}} {}'.format(name, text, value) if text else '{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def labels(method, route):
+    return 'method="{}",route="{}"'.format(method, route.replace('"', '\\"'))
+
+
+def before_request():
+    g.metrics_start = time.perf_counter()
+    g.db_seconds = 0.0
+    g.db_queries = 0
+    g.db_commits = 0
+
+
+def after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    size = 0 if response.is_streamed else (response.calculate_content_length() or 0)
+    current_app.extensions['metrics'].observe(
+        request.method, route, response.status_code, time.perf_counter() - start,
+        g.get('auth_seconds', 0.0), g.get('db_seconds', 0.0), g.get('db_queries', 0), g.get('db_commits', 0), size)
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # the start time goes on the execution context, not in conn.info, because after_cursor_execute
+    # never runs for a failing statement and only the context is discarded along with it
+    context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._query_start
+    if not has_app_context():
+        return
+    if 'metrics_start' in g:
+        g.db_seconds += seconds
+        g.db_queries += 1
+    slow_query_ms = current_app.config.get('SLOW_QUERY_MS')
+    if slow_query_ms and seconds * 1000 >= slow_query_ms:
+        logger.warning('slow query (%.1f ms): %s', seconds * 1000, statement)
+
+
+@event.listens_for(Engine, 'commit')
+def _commit(conn):
+    if has_app_context() and 'metrics_start' in g:
+        g.db_commits += 1
+
+
+def init_app(app):
+    """Records per-request metrics of `app` and exposes them on METRICS_PATH
+    """
+    metrics = app.extensions['metrics'] = Metrics()
+    app.before_request(before_request)
+    app.after_request(after_request)
+
+    @app.route(app.config['METRICS_PATH'], methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,52 @@
+"""create Actor, Movie and Assign
+
+Revision ID: 3f1c2a9b7d10
+Revises: 
+Create Date: 2026-10-18 09:12:04.118219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# databases deployed before migrations existed were created by
+# db.create_all(): only create the tables that are missing
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'Actor' not in tables:
+        op.create_table('Actor',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'Movie' not in tables:
+        op.create_table('Movie',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release_date', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'Assign' not in tables:
+        op.create_table('Assign',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('movie_id', sa.Integer(), nullable=True),
+            sa.Column('actor_id', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['actor_id'], ['Actor.id'], ),
+            sa.ForeignKeyConstraint(['movie_id'], ['Movie.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('Assign')
+    op.drop_table('Movie')
+    op.drop_table('Actor')
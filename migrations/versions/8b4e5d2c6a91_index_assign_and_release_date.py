@@ -0,0 +1,41 @@
+"""unique Assign(movie_id, actor_id), index Assign(actor_id) and Movie(release_date)
+
+Revision ID: 8b4e5d2c6a91
+Revises: 3f1c2a9b7d10
+Create Date: 2026-10-18 09:40:51.603877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4e5d2c6a91'
+down_revision = '3f1c2a9b7d10'
+branch_labels = None
+depends_on = None
+
+
+def existing_indexes(table):
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    # keep the oldest of duplicated assignments so the unique index can be built
+    op.execute(
+        'DELETE FROM "Assign" WHERE id NOT IN '
+        '(SELECT MIN(id) FROM "Assign" GROUP BY movie_id, actor_id)'
+    )
+    assign_indexes = existing_indexes('Assign')
+    if 'ix_Assign_movie_id_actor_id' not in assign_indexes:
+        op.create_index('ix_Assign_movie_id_actor_id', 'Assign', ['movie_id', 'actor_id'], unique=True)
+    if 'ix_Assign_actor_id' not in assign_indexes:
+        op.create_index('ix_Assign_actor_id', 'Assign', ['actor_id'], unique=False)
+    if 'ix_Movie_release_date' not in existing_indexes('Movie'):
+        op.create_index('ix_Movie_release_date', 'Movie', ['release_date', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Movie_release_date', table_name='Movie')
+    op.drop_index('ix_Assign_actor_id', table_name='Assign')
+    op.drop_index('ix_Assign_movie_id_actor_id', table_name='Assign')
@@ -0,0 +1,82 @@
+"""Movie.cast_count and Actor.movie_count, kept by triggers on Assign
+
+Revision ID: a9d3e5f7b102
+Revises: f4c6a8e2b317
+Create Date: 2026-10-18 13:20:54.731046
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d3e5f7b102'
+down_revision = 'f4c6a8e2b317'
+branch_labels = None
+depends_on = None
+
+COUNTS = (('Movie', 'cast_count', 'movie_id'), ('Actor', 'movie_count', 'actor_id'))
+
+TRIGGERS = {
+    'sqlite': [
+        'CREATE TRIGGER assign_counts_insert AFTER INSERT ON "Assign" BEGIN '
+        'UPDATE "Movie" SET cast_count = cast_count + 1 WHERE id = NEW.movie_id; '
+        'UPDATE "Actor" SET movie_count = movie_count + 1 WHERE id = NEW.actor_id; END',
+        'CREATE TRIGGER assign_counts_delete AFTER DELETE ON "Assign" BEGIN '
+        'UPDATE "Movie" SET cast_count = cast_count - 1 WHERE id = OLD.movie_id; '
+        'UPDATE "Actor" SET movie_count = movie_count - 1 WHERE id = OLD.actor_id; END',
+        'CREATE TRIGGER assign_counts_update AFTER UPDATE OF movie_id, actor_id ON "Assign" BEGIN '
+        'UPDATE "Movie" SET cast_count = cast_count - 1 WHERE id = OLD.movie_id; '
+        'UPDATE "Actor" SET movie_count = movie_count - 1 WHERE id = OLD.actor_id; '
+        'UPDATE "Movie" SET cast_count = cast_count + 1 WHERE id = NEW.movie_id; '
+        'UPDATE "Actor" SET movie_count = movie_count + 1 WHERE id = NEW.actor_id; END',
+    ],
+    'postgresql': [
+        'CREATE OR REPLACE FUNCTION assign_counts() RETURNS trigger AS $$ BEGIN '
+        "IF TG_OP IN ('DELETE', 'UPDATE') THEN "
+        'UPDATE "Movie" SET cast_count = cast_count - 1 WHERE id = OLD.movie_id; '
+        'UPDATE "Actor" SET movie_count = movie_count - 1 WHERE id = OLD.actor_id; '
+        'END IF; '
+        "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+        'UPDATE "Movie" SET cast_count = cast_count + 1 WHERE id = NEW.movie_id; '
+        'UPDATE "Actor" SET movie_count = movie_count + 1 WHERE id = NEW.actor_id; '
+        'END IF; '
+        'RETURN NULL; END $$ LANGUAGE plpgsql',
+        'CREATE TRIGGER assign_counts AFTER INSERT OR DELETE OR UPDATE OF movie_id, actor_id '
+        'ON "Assign" FOR EACH ROW EXECUTE PROCEDURE assign_counts()',
+    ],
+}
+
+
+# the tables created by create_all (CREATE_TABLES) have the triggers already
+DROP_TRIGGERS = {
+    'sqlite': ['DROP TRIGGER IF EXISTS {}'.format(name)
+               for name in ('assign_counts_insert', 'assign_counts_delete', 'assign_counts_update')],
+    'postgresql': ['DROP TRIGGER IF EXISTS assign_counts ON "Assign"'],
+}
+
+
+def existing_columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    for table, column, foreign_key in COUNTS:
+        if column not in existing_columns(table):
+            op.add_column(table, sa.Column(column, sa.Integer(), nullable=False, server_default='0'))
+        op.execute('UPDATE "{0}" SET {1} = (SELECT count(*) FROM "Assign" WHERE "Assign".{2} = "{0}".id)'
+                   .format(table, column, foreign_key))
+    dialect = op.get_bind().dialect.name
+    for statement in DROP_TRIGGERS.get(dialect, []) + TRIGGERS.get(dialect, []):
+        op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for statement in DROP_TRIGGERS.get(dialect, []):
+        op.execute(statement)
+    if dialect == 'postgresql':
+        op.execute('DROP FUNCTION IF EXISTS assign_counts()')
+    for table, column, _ in reversed(COUNTS):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column(column)
@@ -0,0 +1,106 @@
+"""updated_at of Actor, Movie and Assign, and the Change feed written by triggers
+
+Revision ID: b6e2d8f4a719
+Revises: a9d3e5f7b102
+Create Date: 2026-10-18 14:05:12.384720
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e2d8f4a719'
+down_revision = 'a9d3e5f7b102'
+branch_labels = None
+depends_on = None
+
+# the columns whose updates are changes
+TABLES = {'Actor': 'name, age, gender', 'Movie': 'title, release_date', 'Assign': 'movie_id, actor_id'}
+
+RECORD_CHANGE = (
+    'CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$ BEGIN '
+    'INSERT INTO "Change" (txid, entity, entity_id, deleted) VALUES (txid_current(), TG_TABLE_NAME, '
+    "CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END, TG_OP = 'DELETE'); "
+    'RETURN NULL; END $$ LANGUAGE plpgsql')
+
+
+def drop_triggers(dialect, table):
+    if dialect == 'postgresql':
+        return ['DROP TRIGGER IF EXISTS "{0}_change" ON "{0}"'.format(table)]
+    return ['DROP TRIGGER IF EXISTS "{}_{}_change"'.format(table, name) for name in ('insert', 'update', 'delete')]
+
+
+def triggers(dialect, table, columns):
+    # the tables created by create_all (CREATE_TABLES) have the triggers already: replace them
+    if dialect == 'postgresql':
+        return drop_triggers(dialect, table) + [
+            'CREATE TRIGGER "{0}_change" AFTER INSERT OR DELETE OR UPDATE OF {1} ON "{0}" '
+            'FOR EACH ROW EXECUTE PROCEDURE record_change()'.format(table, columns)]
+    return drop_triggers(dialect, table) + [
+        'CREATE TRIGGER "{0}_{1}_change" AFTER {2} ON "{0}" BEGIN '
+        'INSERT INTO "Change" (txid, entity, entity_id, deleted) VALUES (0, \'{0}\', {3}.id, {4}); END'
+        .format(table, name, operation, row, deleted)
+        for name, operation, row, deleted in (
+            ('insert', 'INSERT', 'NEW', 0), ('update', 'UPDATE OF ' + columns, 'NEW', 0),
+            ('delete', 'DELETE', 'OLD', 1))]
+
+
+def existing_columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table in TABLES:
+        if 'updated_at' not in existing_columns(table):
+            op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute('UPDATE "{}" SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL'.format(table))
+
+    if not sa.inspect(op.get_bind()).has_table('Change'):
+        op.create_table('Change',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('txid', sa.BigInteger(), server_default='0', nullable=False),
+            sa.Column('entity', sa.String(), nullable=False),
+            sa.Column('entity_id', sa.Integer(), nullable=False),
+            sa.Column('deleted', sa.Boolean(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_Change_txid_id', 'Change', ['txid', 'id'])
+        # the rows already there are the first changes, so a mirror syncs from scratch with the feed alone
+        false = 'FALSE' if dialect == 'postgresql' else '0'
+        for table in TABLES:
+            op.execute('INSERT INTO "Change" (txid, entity, entity_id, deleted) '
+                       'SELECT 0, \'{0}\', id, {1} FROM "{0}" ORDER BY id'.format(table, false))
+
+    if dialect == 'postgresql':
+        op.execute(RECORD_CHANGE)
+    if dialect in ('postgresql', 'sqlite'):
+        for table, columns in TABLES.items():
+            for statement in triggers(dialect, table, columns):
+                op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    kept = []
+    for table in TABLES:
+        if dialect in ('postgresql', 'sqlite'):
+            for statement in drop_triggers(dialect, table):
+                op.execute(statement)
+        if dialect == 'sqlite':
+            # SQLite recreates the tables below, which their other triggers (the Assign
+            # counts of a9d3e5f7b102) do not survive: set them aside until it is done
+            for name, sql in op.get_bind().execute(sa.text(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = :table"), table=table):
+                op.execute('DROP TRIGGER "{}"'.format(name))
+                kept.append(sql)
+    if dialect == 'postgresql':
+        op.execute('DROP FUNCTION IF EXISTS record_change()')
+    op.drop_index('ix_Change_txid_id', table_name='Change')
+    op.drop_table('Change')
+    for table in reversed(list(TABLES)):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+    for statement in kept:
+        op.execute(statement)
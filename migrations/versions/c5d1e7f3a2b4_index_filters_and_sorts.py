@@ -0,0 +1,44 @@
+"""index the filter and sort keys of GET /actors and GET /movies
+
+Revision ID: c5d1e7f3a2b4
+Revises: 8b4e5d2c6a91
+Create Date: 2026-10-18 11:20:37.118240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d1e7f3a2b4'
+down_revision = '8b4e5d2c6a91'
+branch_labels = None
+depends_on = None
+
+
+def existing_indexes(table):
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    actor_indexes = existing_indexes('Actor')
+    if 'ix_Actor_gender_age' not in actor_indexes:
+        op.create_index('ix_Actor_gender_age', 'Actor', ['gender', 'age'], unique=False)
+    if 'ix_Actor_age' not in actor_indexes:
+        op.create_index('ix_Actor_age', 'Actor', ['age', 'id'], unique=False)
+    if 'ix_Actor_name' not in actor_indexes:
+        op.create_index('ix_Actor_name', 'Actor', ['name', 'id'], unique=False)
+    movie_indexes = existing_indexes('Movie')
+    if 'ix_Movie_title' not in movie_indexes:
+        op.create_index('ix_Movie_title', 'Movie', ['title', 'id'], unique=False)
+    if 'ix_Movie_title_pattern' not in movie_indexes:
+        op.create_index('ix_Movie_title_pattern', 'Movie', ['title'], unique=False,
+                        postgresql_ops={'title': 'text_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_Movie_title_pattern', table_name='Movie')
+    op.drop_index('ix_Movie_title', table_name='Movie')
+    op.drop_index('ix_Actor_name', table_name='Actor')
+    op.drop_index('ix_Actor_age', table_name='Actor')
+    op.drop_index('ix_Actor_gender_age', table_name='Actor')
@@ -0,0 +1,32 @@
+"""GIN full-text indexes of Actor.name and Movie.title for GET /search
+
+Revision ID: d2a8f4b6c913
+Revises: c5d1e7f3a2b4
+Create Date: 2026-10-18 11:42:08.530912
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a8f4b6c913'
+down_revision = 'c5d1e7f3a2b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite runs search with LIKE, only PostgreSQL has tsvectors
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE INDEX IF NOT EXISTS "ix_Actor_name_search" ON "Actor" '
+               "USING gin (to_tsvector('simple', name))")
+    op.execute('CREATE INDEX IF NOT EXISTS "ix_Movie_title_search" ON "Movie" '
+               "USING gin (to_tsvector('simple', title))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('DROP INDEX IF EXISTS "ix_Movie_title_search"')
+    op.execute('DROP INDEX IF EXISTS "ix_Actor_name_search"')
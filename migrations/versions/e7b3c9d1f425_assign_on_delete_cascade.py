@@ -0,0 +1,43 @@
+"""ON DELETE CASCADE on the foreign keys of Assign
+
+Revision ID: e7b3c9d1f425
+Revises: d2a8f4b6c913
+Create Date: 2026-10-18 12:05:14.772031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3c9d1f425'
+down_revision = 'd2a8f4b6c913'
+branch_labels = None
+depends_on = None
+
+# names the unnamed foreign keys SQLite reflects, so that batch mode can drop them
+NAMING_CONVENTION = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+
+def replace_foreign_keys(ondelete):
+    foreign_keys = sa.inspect(op.get_bind()).get_foreign_keys('Assign')
+    with op.batch_alter_table('Assign', naming_convention=NAMING_CONVENTION) as batch_op:
+        for foreign_key in foreign_keys:
+            name = foreign_key['name'] or NAMING_CONVENTION['fk'] % {
+                'table_name': 'Assign',
+                'column_0_name': foreign_key['constrained_columns'][0],
+                'referred_table_name': foreign_key['referred_table']}
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, foreign_key['referred_table'], foreign_key['constrained_columns'],
+                                        foreign_key['referred_columns'], ondelete=ondelete)
+
+
+def upgrade():
+    # orphans left by deletes that did not remove the assigns would block the constraints
+    op.execute('DELETE FROM "Assign" WHERE movie_id NOT IN (SELECT id FROM "Movie") '
+               'OR actor_id NOT IN (SELECT id FROM "Actor")')
+    replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    replace_foreign_keys(None)
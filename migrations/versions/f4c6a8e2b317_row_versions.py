@@ -0,0 +1,32 @@
+"""Actor.version and Movie.version, the ETags of the rows
+
+Revision ID: f4c6a8e2b317
+Revises: e7b3c9d1f425
+Create Date: 2026-10-18 12:31:46.208593
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4c6a8e2b317'
+down_revision = 'e7b3c9d1f425'
+branch_labels = None
+depends_on = None
+
+
+def existing_columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    for table in ('Actor', 'Movie'):
+        if 'version' not in existing_columns(table):
+            op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    for table in ('Movie', 'Actor'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('version')
@@ -1,27 +1,697 @@
 import os
-from sqlalchemy import Column, String, create_engine
-from flask import Flask, abort, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, Column, String, create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from flask import Flask, abort, g, jsonify, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+import base64
+import binascii
 import json
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import joinedload, selectinload, subqueryload, sessionmaker
+import cache
 
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+def normalize_url(url):
+  if url and url.startswith("postgres://"):
+    return url.replace("postgres://", "postgresql://", 1)
+  return url
+
+
+def in_memory(url):
+  return url in ('sqlite://', 'sqlite:///:memory:')
+
+
+'''
+InstrumentedQueuePool
+    QueuePool that counts checkouts and how long they waited for a
+    connection, to size DB_POOL_SIZE / DB_MAX_OVERFLOW from data
+'''
+class InstrumentedQueuePool(QueuePool):
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.checkouts = 0
+    self.timeouts = 0
+    self.wait_seconds = 0.0
+    self.max_wait_seconds = 0.0
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      return super()._do_get()
+    except exc.TimeoutError:
+      self.timeouts += 1
+      raise
+    finally:
+      waited = time.perf_counter() - start
+      self.checkouts += 1
+      self.wait_seconds += waited
+      self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+  def stats(self):
+    return {
+      'size': self.size(),
+      'checked_out': self.checkedout(),
+      'overflow': self.overflow(),
+      'checkouts': self.checkouts,
+      'timeouts': self.timeouts,
+      'wait_seconds': self.wait_seconds,
+      'max_wait_seconds': self.max_wait_seconds}
+
+
+'''
+RoutingSession
+    sends the queries of GET/HEAD requests to the 'replica' bind when
+    DATABASE_REPLICA_URL is set; writes and everything else use the primary,
+    as do the requests filling the response cache (g.read_from_primary)
+'''
+class RoutingSession(SignallingSession):
+  def __init__(self, db, **options):
+    self.db = db
+    super().__init__(db, **options)
+
+  def get_bind(self, mapper=None, clause=None, **kwargs):
+    # the scoped_session proxy passes bind= and private flags, which SignallingSession ignores too
+    if not self._flushing and self.uses_replica():
+      return self.db.get_engine(self.app, bind='replica')
+    return super().get_bind(mapper, clause)
+
+  def uses_replica(self):
+    return ('replica' in (self.app.config.get('SQLALCHEMY_BINDS') or {})
+            and has_request_context()
+            and request.method in ('GET', 'HEAD')
+            and not g.get('read_from_primary')
+            and not (self.new or self.dirty or self.deleted))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+def setting(app, name, default, cast=str):
+  value = app.config.get(name, os.environ.get(name))
+  if value is None:
+    return default
+  if cast is bool and isinstance(value, str):
+    return value.lower() in ('1', 'true', 'yes')
+  return cast(value)
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+  # SQLite only enforces foreign keys, and their ON DELETE CASCADE, when asked to
+  if isinstance(dbapi_connection, sqlite3.Connection):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+'''
+engine_options(app, url)
+    pool and timeout settings of the engines, from the app config or
+    the environment: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE, DB_POOL_PRE_PING and DB_STATEMENT_TIMEOUT_MS
+'''
+def engine_options(app, url):
+  options = {}
+  if url.startswith('sqlite'):
+    return options
+  options.update(
+    poolclass=InstrumentedQueuePool,
+    pool_size=setting(app, 'DB_POOL_SIZE', 5, int),
+    max_overflow=setting(app, 'DB_MAX_OVERFLOW', 10, int),
+    pool_timeout=setting(app, 'DB_POOL_TIMEOUT', 30, int),
+    pool_recycle=setting(app, 'DB_POOL_RECYCLE', 1800, int),
+    pool_pre_ping=setting(app, 'DB_POOL_PRE_PING', True, bool))
+  statement_timeout = setting(app, 'DB_STATEMENT_TIMEOUT_MS', 0, int)
+  if statement_timeout and url.startswith('postgresql'):
+    options['connect_args'] = {'options': '-c statement_timeout={}'.format(statement_timeout)}
+  return options
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, to DATABASE_URL
+    unless `database_path` is given. The engine is only built on first
+    use and the schema is left to the migrations: CREATE_TABLES creates
+    the missing tables at boot, as is done for in-memory SQLite databases.
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    database_path = normalize_url(database_path or os.environ['DATABASE_URL'])
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app, database_path))
+    replica_path = normalize_url(setting(app, 'DATABASE_REPLICA_URL', None))
+    if replica_path:
+        app.config.setdefault("SQLALCHEMY_BINDS", {})['replica'] = replica_path
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if setting(app, 'CREATE_TABLES', in_memory(database_path), bool):
+      with app.app_context():
+        db.create_all()
+
+
+'''
+pool_stats(app)
+    checkout/wait counters of the connection pools, per bind
+'''
+def pool_stats(app=None):
+  app = db.get_app(app)
+  stats = {}
+  for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+    pool = db.get_engine(app, bind=bind).pool
+    if isinstance(pool, InstrumentedQueuePool):
+      stats[bind or 'primary'] = pool.stats()
+  return stats
+
+
+'''
+CAST_LOADERS
+    loading strategies for Movie.actors / Actor.movies:
+    joined issues one query, selectin and subquery issue two,
+    whatever the size of the cast.
+'''
+CAST_LOADERS = {
+  'joined': joinedload,
+  'selectin': selectinload,
+  'subquery': subqueryload}
+
+
+'''
+CountCache
+    row counts per table, re-counted at most every `ttl` seconds
+    and dropped as soon as a row is inserted or deleted in this process.
+    ttl=0 counts on every call. Counts restricted by `filters` are not cached.
+'''
+class CountCache:
+  def __init__(self, ttl=30):
+    self.ttl = ttl
+    self._counts = {}
+    self._lock = threading.Lock()
+
+  def get(self, model, filters=()):
+    if filters:
+      # too many combinations to cache, the response cache keeps the result
+      return db.session.query(db.func.count(model.id)).filter(*filters).scalar()
+    key = (db.engine, model.__tablename__)
+    now = time.monotonic()
+    with self._lock:
+      entry = self._counts.get(key)
+    if entry is not None and now - entry[0] < self.ttl:
+      return entry[1]
+    count = db.session.query(db.func.count(model.id)).scalar()
+    with self._lock:
+      self._counts[key] = (now, count)
+    return count
+
+  def invalidate(self, model):
+    with self._lock:
+      for key in [key for key in self._counts if key[1] == model.__tablename__]:
+        del self._counts[key]
+
+
+row_counts = CountCache(int(os.environ.get('COUNT_CACHE_TTL', 30)))
+
+
+'''
+paginate(model, after, limit, fields, filters, join, sort, descending)
+    keyset page of `model` ordered by `sort` (one of model.SORTS) then id,
+    starting after the cursor `after`: an id when sorting by id, else the
+    (sort value, id) of the last row of the previous page.
+    Only the columns in `fields` are selected (all of model.FIELDS by default),
+    from `model` joined with `join` when given, and restricted by `filters`.
+    Returns the rows as dicts and the cursor of the next page (None on the last page).
+'''
+def paginate(model, after=None, limit=100, fields=None, filters=(), join=None, sort='id', descending=False):
+  fields = list(fields or model.FIELDS)
+  for field in ('id', sort):
+    if field not in fields:
+      fields.append(field)
+  query = db.session.query(*[getattr(model, field) for field in fields])
+  if join is not None:
+    query = query.join(*join)
+  query = query.filter(*filters)
+  if sort == 'id':
+    if after is not None:
+      query = query.filter(model.id < after if descending else model.id > after)
+    query = query.order_by(model.id.desc() if descending else model.id)
+  else:
+    column = getattr(model, sort)
+    if after is not None:
+      query = query.filter(keyset_after(model, column, after, descending))
+    # the NULL placement of PostgreSQL b-tree indexes, so that they serve both directions
+    if descending:
+      query = query.order_by(column.desc().nulls_first(), model.id.desc())
+    else:
+      query = query.order_by(column.asc().nulls_last(), model.id)
+  rows = query.limit(limit + 1).all()
+  cursor = None
+  if len(rows) > limit:
+    last = rows[limit - 1]
+    cursor = last.id if sort == 'id' else (getattr(last, sort), last.id)
+  return [dict(zip(fields, row)) for row in rows[:limit]], cursor
+
+
+'''
+casts(movie_ids, fields)
+    the casts of the movies with one query over Assign per chunk of ids:
+    ({movie_id: [actor_id, ...]}, [actor, ...]), an actor playing in
+    several of the movies listed once, in id order
+'''
+def casts(movie_ids, fields=None, chunk_size=500):
+  fields = list(fields or Actor.FIELDS)
+  if 'id' not in fields:
+    fields.append('id')
+  cast_ids, actors = {}, {}
+  for chunk in chunked(list(movie_ids), chunk_size):
+    query = db.session.query(Assign.movie_id, *[getattr(Actor, field) for field in fields]) \
+      .join(Actor, Actor.id==Assign.actor_id) \
+      .filter(Assign.movie_id.in_(chunk)) \
+      .order_by(Assign.movie_id, Assign.actor_id)
+    for movie_id, *values in query:
+      actor = dict(zip(fields, values))
+      cast_ids.setdefault(movie_id, []).append(actor['id'])
+      actors.setdefault(actor['id'], actor)
+  return cast_ids, [actors[id] for id in sorted(actors)]
+
+
+def keyset_after(model, column, after, descending):
+  value, last_id = after
+  if descending:
+    if value is None:
+      return db.or_(column.isnot(None), db.and_(column.is_(None), model.id < last_id))
+    return db.tuple_(column, model.id) < (value, last_id)
+  if value is None:
+    return db.and_(column.is_(None), model.id > last_id)
+  return db.or_(db.tuple_(column, model.id) > (value, last_id), column.is_(None))
+
+
+'''
+encode_cursor(cursor) / decode_cursor(model, sort, token)
+    the (sort value, id) cursors of sorted pages travel as opaque url-safe tokens.
+    decode_cursor raises ValueError on tokens it did not produce.
+'''
+def encode_cursor(cursor):
+  value, last_id = cursor
+  if isinstance(value, datetime):
+    value = value.isoformat()
+  raw = json.dumps([value, last_id], separators=(',', ':')).encode()
+  return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(model, sort, token):
+  try:
+    value, last_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+  except (TypeError, binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+    raise ValueError('invalid cursor')
+  if not isinstance(last_id, int) or isinstance(last_id, bool):
+    raise ValueError('invalid cursor')
+  if value is None:
+    return value, last_id
+  column_type = getattr(model, sort).type
+  if isinstance(column_type, db.DateTime):
+    if not isinstance(value, str):
+      raise ValueError('invalid cursor')
+    value = datetime.fromisoformat(value)
+  elif not isinstance(value, column_type.python_type) or isinstance(value, bool):
+    # compared with the column in SQL: a value of another type is an error there
+    raise ValueError('invalid cursor')
+  return value, last_id
+
+
+'''
+iter_rows(model, fields, batch_size)
+    every row of `model` as a dict, ordered by id, read through a
+    server-side cursor `batch_size` rows at a time
+'''
+def iter_rows(model, fields=None, batch_size=1000):
+  fields = list(fields or model.FIELDS)
+  if 'id' not in fields:
+    fields.append('id')
+  query = db.session.query(*[getattr(model, field) for field in fields]) \
+    .order_by(model.id) \
+    .execution_options(stream_results=True) \
+    .yield_per(batch_size)
+  for row in query:
+    yield dict(zip(fields, row))
+
+
+# text search configuration of the search indexes: no stemming, names are not prose
+SEARCH_CONFIG = db.literal_column("'simple'")
+
+
+'''
+search(model, text, limit, offset)
+    the rows of `model` whose model.SEARCH_FIELD has words starting with
+    every word of `text`, best matches first. On PostgreSQL this is a
+    prefix full-text query served by the GIN index of the column's
+    'simple' tsvector, ranked with ts_rank; elsewhere (SQLite test runs)
+    a LIKE per word, ranking the values starting with `text` first.
+    Returns a page of rows as dicts and whether more rows follow.
+'''
+def search(model, text, limit=10, offset=0):
+  words = re.findall(r'\w+', text.lower())
+  if not words:
+    return [], False
+  column = getattr(model, model.SEARCH_FIELD)
+  query = db.session.query(*[getattr(model, field) for field in model.FIELDS])
+  if db.session.get_bind().dialect.name == 'postgresql':
+    vector = db.func.to_tsvector(SEARCH_CONFIG, column)
+    terms = db.func.to_tsquery(SEARCH_CONFIG, ' & '.join(word + ':*' for word in words))
+    query = query.filter(vector.op('@@')(terms)) \
+      .order_by(db.func.ts_rank(vector, terms).desc(), db.func.length(column), model.id)
+  else:
+    value = db.func.lower(column)
+    for word in words:
+      query = query.filter(db.or_(value.startswith(word, autoescape=True),
+                                  value.contains(' ' + word, autoescape=True)))
+    starts = db.case((value.startswith(' '.join(words), autoescape=True), 0), else_=1)
+    query = query.order_by(starts, db.func.length(column), model.id)
+  rows = query.offset(offset).limit(limit + 1).all()
+  return [dict(zip(model.FIELDS, row)) for row in rows[:limit]], len(rows) > limit
+
+
+'''
+UnitOfWork
+The writes of a request, staged: inside one, commit() only flushes and
+the request commits once when it ends (see end_unit_of_work). The
+callbacks registered with after_commit, e.g. the cache invalidations,
+wait for that commit. Outside of a request (scripts, the tests working
+in an app context) commit() commits right away, as do the callbacks.
+'''
+class UnitOfWork:
+  def __init__(self):
+    # whether writes were sent, i.e. whether there is anything a failure may not undo
+    self.staged = False
+    self.callbacks = []
+
+
+def current_unit_of_work():
+  return g.get('unit_of_work') if has_request_context() else None
+
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stage_writes(conn, cursor, statement, parameters, context, executemany):
+  # every write counts, the flushes of commit() as well as the bulk helpers and raw statements
+  unit = current_unit_of_work()
+  if unit is None or unit.staged:
+    return
+  if context.isinsert or context.isupdate or context.isdelete \
+      or statement.lstrip().upper().startswith(WRITES):
+    unit.staged = True
+
+
+def begin_unit_of_work():
+  g.unit_of_work = UnitOfWork()
+
+
+'''
+end_unit_of_work(success)
+    commits the unit of work of the request when `success`, rolls it
+    back otherwise, then runs the after_commit callbacks it calls for
+'''
+def end_unit_of_work(success=True):
+  unit = g.pop('unit_of_work', None)
+  if unit is None:
+    return
+  committed = False
+  try:
+    if success:
+      commit()
+      committed = True
+    else:
+      db.session.rollback()
+  except Exception:
+    db.session.rollback()
+    raise
+  finally:
+    for on_commit, on_rollback in unit.callbacks:
+      callback = on_commit if committed else on_rollback
+      if callback is not None:
+        callback()
+
+
+def commit():
+  unit = current_unit_of_work()
+  if unit is None:
+    db.session.commit()
+  else:
+    db.session.flush()
+    unit.staged = True
+
+
+def after_commit(callback, on_rollback=None):
+  """Runs `callback` once the writes so far are committed, `on_rollback` if they are not
+  """
+  unit = current_unit_of_work()
+  if unit is None:
+    callback()
+  else:
+    unit.callbacks.append((callback, on_rollback))
+
+
+'''
+savepoint()
+    for the writes that may fail on their own, e.g. one item of a batch:
+    an exception raised in the block undoes the writes of the block only.
+    It takes a SAVEPOINT when the unit of work has sent writes to keep;
+    otherwise there is nothing else to undo and the transaction is rolled
+    back, sparing the round trips.
+'''
+@contextmanager
+def savepoint():
+  unit = current_unit_of_work()
+  if unit is not None and unit.staged:
+    with db.session.begin_nested():
+      yield
+    return
+  try:
+    yield
+  except Exception:
+    db.session.rollback()
+    raise
+
+
+'''
+init_unit_of_work(app)
+    stages the writes of every POST, PATCH, PUT and DELETE request of
+    `app` in a UnitOfWork, committed when the response is not an error.
+    UNIT_OF_WORK=false commits every write on its own instead.
+'''
+def init_unit_of_work(app):
+  if not setting(app, 'UNIT_OF_WORK', True, bool):
+    return
+
+  @app.before_request
+  def begin():
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+      begin_unit_of_work()
+
+  @app.after_request
+  def end(response):
+    end_unit_of_work(response.status_code < 400)
+    return response
+
+  @app.teardown_request
+  def abandon(error=None):
+    # left open when a later after_request hook failed
+    end_unit_of_work(False)
+
+
+'''
+cache_tags(model, rows)
+    tags of the cached responses that depend on `rows` (instances or dicts) of `model`
+'''
+def cache_tags(model, rows=()):
+  def value(row, column):
+    return row[column] if isinstance(row, dict) else getattr(row, column)
+  if model is Actor:
+    return ['Actor'] + ['Actor:{}'.format(value(row, 'id')) for row in rows]
+  if model is Movie:
+    return ['Movie'] + ['Movie:{}'.format(value(row, 'id')) for row in rows]
+  return ['Assign'] + ['Movie:{}'.format(value(row, 'movie_id')) for row in rows] + \
+    ['Actor:{}'.format(value(row, 'actor_id')) for row in rows]
+
+
+'''
+invalidate(model, rows, counts)
+    drops the cached responses, and with counts=True the cached
+    row count, that depend on `rows` of `model`, once the writes are
+    committed. The responses tagged 'Assign' serve the cast and
+    filmography counts.
+'''
+def invalidate(model, rows=(), counts=True):
+  tags = cache_tags(model, rows)
+  if counts and model is not Assign:
+    # deleted actors and movies take their assigns along
+    tags.append('Assign')
+
+  def drop():
+    if counts:
+      row_counts.invalidate(model)
+    cache.invalidate(*tags)
+  after_commit(drop)
+
+
+def chunked(items, size):
+  for start in range(0, len(items), size):
+    yield items[start:start + size]
+
+
+'''
+bulk_insert / bulk_update / bulk_delete / existing_ids
+    write or look up many rows of `model`, chunk_size rows per statement,
+    inside the current transaction: the caller commits once at the end.
+'''
+def bulk_insert(model, rows, chunk_size=500):
+  for chunk in chunked(rows, chunk_size):
+    db.session.bulk_insert_mappings(model, chunk, return_defaults=True)
+  invalidate(model, rows)
+  return [row['id'] for row in rows]
+
+
+def bulk_update(model, rows, chunk_size=500):
+  # one executemany UPDATE per set of columns, bumping the version of every row
+  groups = {}
+  for row in rows:
+    groups.setdefault(tuple(sorted(key for key in row if key != 'id')), []).append(row)
+  for columns, group in groups.items():
+    values = {column: db.bindparam('b_' + column) for column in columns}
+    values['version'] = model.version + 1
+    statement = db.update(model).where(model.id==db.bindparam('b_id')).values(values) \
+      .execution_options(synchronize_session=False)
+    for chunk in chunked(group, chunk_size):
+      db.session.execute(statement, [{'b_' + key: value for key, value in row.items()} for row in chunk])
+  invalidate(model, rows, counts=False)
+
+
+def bulk_delete(model, ids, chunk_size=500):
+  rows = [] if model is Assign else [{'id': id} for id in ids]
+  for chunk in chunked(ids, chunk_size):
+    if model is Actor:
+      Assign.query.filter(Assign.actor_id.in_(chunk)).delete(synchronize_session=False)
+    elif model is Movie:
+      Assign.query.filter(Assign.movie_id.in_(chunk)).delete(synchronize_session=False)
+    else:
+      rows += [{'movie_id': movie_id, 'actor_id': actor_id} for movie_id, actor_id in
+               db.session.query(Assign.movie_id, Assign.actor_id).filter(Assign.id.in_(chunk))]
+    model.query.filter(model.id.in_(chunk)).delete(synchronize_session=False)
+  invalidate(model, rows)
+
+
+'''
+patch_row(model, id, values, versions)
+    one UPDATE writing the `values` that differ from the row `id` and
+    bumping its version, only while the row is at one of `versions` when
+    given. Returns (outcome, version of the row): outcome is 'updated',
+    'unchanged', 'conflict' (the row is at another version) or 'missing'.
+'''
+def patch_row(model, id, values, versions=None):
+  criteria = [model.id==id]
+  if versions is not None:
+    criteria.append(model.version.in_(versions))
+  updated = None
+  if values:
+    # skips the write, and the row lock, when every value is already there
+    changed = db.or_(*[getattr(model, column).is_distinct_from(value) for column, value in values.items()])
+    statement = db.update(model).where(*criteria, changed).values(dict(values, version=model.version + 1)) \
+      .execution_options(synchronize_session=False)
+    if db.session.get_bind().dialect.full_returning:
+      updated = db.session.execute(statement.returning(model.version)).scalar()
+    elif db.session.execute(statement).rowcount:
+      # SQLAlchemy 1.4 has no UPDATE ... RETURNING for SQLite
+      updated = versions[0] + 1 if versions is not None and len(versions) == 1 else \
+        db.session.query(model.version).filter(model.id==id).scalar()
+    commit()
+  if updated is not None:
+    invalidate(model, [{'id': id}], counts=False)
+    return 'updated', updated
+  # nothing written: find out why, without locking anything
+  current = db.session.query(model.version).filter(model.id==id).scalar()
+  commit()
+  if current is None:
+    return 'missing', None
+  if versions is not None and current not in versions:
+    return 'conflict', current
+  return 'unchanged', current
+
+
+'''
+delete_row(model, id)
+    one DELETE of the row `id`. False when there is no such
+    row; the assigns of a deleted actor or movie go with it through the
+    ON DELETE CASCADE of their foreign keys.
+'''
+def delete_row(model, id):
+  deleted = model.query.filter(model.id==id).delete(synchronize_session=False)
+  commit()
+  if deleted:
+    invalidate(model, [{'id': id}])
+  return deleted > 0
+
+
+def existing_ids(model, ids, chunk_size=500):
+  found = set()
+  for chunk in chunked(list(ids), chunk_size):
+    found.update(id for (id,) in db.session.query(model.id).filter(model.id.in_(chunk)))
+  return found
+
+
+'''
+changes_since(after, limit)
+    the changes recorded after the cursor `after` ((txid, id) of the
+    last change read, None for all), at most `limit` of them in the
+    order they were recorded. A row changed several times is listed
+    once, at its last change, with its current FIELDS and updated_at;
+    deleted rows are tombstones without them. Returns (changes, cursor
+    of the last change read, whether more changes follow).
+'''
+def changes_since(after=None, limit=100, chunk_size=500):
+  query = db.session.query(Change.txid, Change.id, Change.entity, Change.entity_id, Change.deleted)
+  if after is not None:
+    query = query.filter(db.tuple_(Change.txid, Change.id) > after)
+  if db.session.get_bind().dialect.name == 'postgresql':
+    # transactions from the oldest one still running on may yet commit changes ordered
+    # before theirs: read only the changes of the transactions that are all done
+    query = query.filter(Change.txid < db.func.txid_snapshot_xmin(db.func.txid_current_snapshot()))
+  rows = query.order_by(Change.txid, Change.id).limit(limit + 1).all()
+  more = len(rows) > limit
+  rows = rows[:limit]
+  if not rows:
+    return [], after, more
+
+  latest = {}
+  for row in rows:
+    latest.pop((row.entity, row.entity_id), None)
+    latest[(row.entity, row.entity_id)] = row
+  current = {}
+  for model in (Actor, Movie, Assign):
+    ids = [id for (entity, id), row in latest.items() if entity == model.__tablename__ and not row.deleted]
+    fields = list(model.FIELDS) + ['updated_at']
+    for chunk in chunked(ids, chunk_size):
+      for values in db.session.query(*[getattr(model, field) for field in fields]).filter(model.id.in_(chunk)):
+        current[(model.__tablename__, values.id)] = dict(zip(fields, values))
+
+  changes = []
+  for key, row in latest.items():
+    # missing rows were deleted by a change a later page holds
+    data = current.get(key)
+    change = {'type': row.entity.lower(), 'id': row.entity_id, 'deleted': data is None}
+    if data is not None:
+      change['row'] = data
+    changes.append(change)
+  return changes, (rows[-1].txid, rows[-1].id), more
 
 
 '''
@@ -30,11 +700,30 @@ Have title and release year
 '''
 class Actor(db.Model):  
   __tablename__ = 'Actor'
+  __table_args__ = (
+    db.Index('ix_Actor_gender_age', 'gender', 'age'),
+    db.Index('ix_Actor_age', 'age', 'id'),
+    db.Index('ix_Actor_name', 'name', 'id'),
+  )
+  FIELDS = ('id', 'name', 'age', 'gender')
+  SORTS = ('id', 'name', 'age')
+  # GIN indexed on PostgreSQL by migration d2a8f4b6c913
+  SEARCH_FIELD = 'name'
+  # served by ?include=counts
+  COUNT_FIELD = 'movie_count'
 
   id = Column(db.Integer, primary_key=True)
   name = Column(String)
   age = Column(db.Integer)
   gender = Column(String)
+  # bumped by every update, served as the ETag of the row
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
+  # movies the actor is assigned to, kept by the Assign triggers
+  movie_count = Column(db.Integer, nullable=False, default=0, server_default='0')
+  updated_at = Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+  assigns = db.relationship('Assign', back_populates='actor', cascade='all, delete-orphan', passive_deletes=True)
+  movies = db.relationship('Movie', secondary='Assign', viewonly=True, order_by='Movie.id')
 
   def __init__(self, name, age, gender):
     self.name = name
@@ -43,14 +732,18 @@ class Actor(db.Model):
 
   def insert(self):
       db.session.add(self)
-      db.session.commit()
+      commit()
+      invalidate(Actor, [self])
 
   def update(self):
-      db.session.commit()
+      self.version = Actor.version + 1
+      commit()
+      invalidate(Actor, [self], counts=False)
 
   def delete(self):
       db.session.delete(self)
-      db.session.commit()
+      commit()
+      invalidate(Actor, [self])
 
   def format(self):
     return {
@@ -62,10 +755,30 @@ class Actor(db.Model):
 
 class Movie(db.Model):  
   __tablename__ = 'Movie'
+  __table_args__ = (
+    db.Index('ix_Movie_release_date', 'release_date', 'id'),
+    db.Index('ix_Movie_title', 'title', 'id'),
+    # serves the title LIKE 'prefix%' filters whatever the collation of the database
+    db.Index('ix_Movie_title_pattern', 'title', postgresql_ops={'title': 'text_pattern_ops'}),
+  )
+  FIELDS = ('id', 'title', 'release_date')
+  SORTS = ('id', 'title', 'release_date')
+  # GIN indexed on PostgreSQL by migration d2a8f4b6c913
+  SEARCH_FIELD = 'title'
+  # served by ?include=counts
+  COUNT_FIELD = 'cast_count'
 
   id = Column(db.Integer, primary_key=True)
   title = Column(String)
   release_date = Column(db.DateTime)
+  # bumped by every update, served as the ETag of the row
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
+  # actors assigned to the movie, kept by the Assign triggers
+  cast_count = Column(db.Integer, nullable=False, default=0, server_default='0')
+  updated_at = Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+  assigns = db.relationship('Assign', back_populates='movie', cascade='all, delete-orphan', passive_deletes=True)
+  actors = db.relationship('Actor', secondary='Assign', viewonly=True, order_by='Actor.id')
 
   def __init__(self, title, release_date):
     self.title = title
@@ -73,14 +786,18 @@ class Movie(db.Model):
 
   def insert(self):
       db.session.add(self)
-      db.session.commit()
+      commit()
+      invalidate(Movie, [self])
 
   def update(self):
-      db.session.commit()
+      self.version = Movie.version + 1
+      commit()
+      invalidate(Movie, [self], counts=False)
 
   def delete(self):
       db.session.delete(self)
-      db.session.commit()
+      commit()
+      invalidate(Movie, [self])
 
   def format(self):
     return {
@@ -88,18 +805,46 @@ class Movie(db.Model):
       'title': self.title,
       'release_date': self.release_date}
 
-  @hybrid_property
-  def actors(self):
-    assigns = Assign.query.filter(Assign.movie_id==self.id).all()
-    return [Actor.query.filter(Actor.id==assign.actor_id).first() for assign in assigns]
-  
+  @classmethod
+  def with_actors(cls, movie_id, strategy='selectin'):
+    return cls.query.options(CAST_LOADERS[strategy](cls.actors)).filter(cls.id==movie_id).one_or_none()
+
+  '''
+  of_actor(actor_id)
+      join and filter for paginate: the movies `actor_id` is assigned to,
+      through the Assign(actor_id) index
+  '''
+  @classmethod
+  def of_actor(cls, actor_id):
+    return {'join': (Assign, Assign.movie_id==cls.id), 'filters': [Assign.actor_id==actor_id]}
+
+  '''
+  assigns_of(actor_ids)
+      {actor_id: assign_id} of the given actors already assigned to the movie
+  '''
+  def assigns_of(self, actor_ids, chunk_size=500):
+    found = {}
+    for chunk in chunked(list(actor_ids), chunk_size):
+      found.update(db.session.query(Assign.actor_id, Assign.id)
+                   .filter(Assign.movie_id==self.id, Assign.actor_id.in_(chunk)))
+    return found
+
 
 class Assign(db.Model):  
   __tablename__ = 'Assign'
+  __table_args__ = (
+    db.Index('ix_Assign_movie_id_actor_id', 'movie_id', 'actor_id', unique=True),
+    db.Index('ix_Assign_actor_id', 'actor_id'),
+  )
+  FIELDS = ('id', 'movie_id', 'actor_id')
 
   id = Column(db.Integer, primary_key=True)
-  movie_id = db.Column(db.Integer, db.ForeignKey('Movie.id'))
-  actor_id = db.Column(db.Integer, db.ForeignKey('Actor.id'))
+  movie_id = db.Column(db.Integer, db.ForeignKey('Movie.id', ondelete='CASCADE'))
+  actor_id = db.Column(db.Integer, db.ForeignKey('Actor.id', ondelete='CASCADE'))
+  updated_at = Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+  movie = db.relationship('Movie', back_populates='assigns')
+  actor = db.relationship('Actor', back_populates='assigns')
 
   def __init__(self, movie_id, actor_id):
     self.movie_id = movie_id
@@ -107,17 +852,161 @@ class Assign(db.Model):
 
   def insert(self):
       db.session.add(self)
-      db.session.commit()
+      commit()
+      invalidate(Assign, [self])
 
   def update(self):
-      db.session.commit()
+      commit()
+      invalidate(Assign, [self], counts=False)
 
   def delete(self):
       db.session.delete(self)
-      db.session.commit()
+      commit()
+      invalidate(Assign, [self])
+
+  '''
+  link(movie_id, actor_id)
+      id of the assign of the actor to the movie, inserted unless it exists.
+      The foreign keys reject missing movies and actors: None then.
+  '''
+  @classmethod
+  def link(cls, movie_id, actor_id):
+    assign = cls(movie_id=movie_id, actor_id=actor_id)
+    try:
+      with savepoint():
+        db.session.add(assign)
+        db.session.flush()
+    except exc.IntegrityError:
+      # already assigned (Assign(movie_id, actor_id) is unique), or no such movie or actor
+      return db.session.query(cls.id).filter(cls.movie_id==movie_id, cls.actor_id==actor_id).scalar()
+    # read before the commit expires the instance and reloading it costs a SELECT
+    assign_id = assign.id
+    commit()
+    invalidate(cls, [{'movie_id': movie_id, 'actor_id': actor_id}])
+    return assign_id
+
+  '''
+  unlink(movie_id, actor_id)
+      deletes the assign of the actor to the movie with one
+      DELETE ... RETURNING and returns its id, None when there was none
+  '''
+  @classmethod
+  def unlink(cls, movie_id, actor_id):
+    criteria = (cls.movie_id==movie_id, cls.actor_id==actor_id)
+    statement = db.delete(cls).where(*criteria)
+    if db.session.get_bind().dialect.full_returning:
+      assign_id = db.session.execute(statement.returning(cls.id)).scalar()
+    else:
+      # SQLAlchemy 1.4 has no DELETE ... RETURNING for SQLite
+      assign_id = db.session.query(cls.id).filter(*criteria).scalar()
+      if assign_id is not None:
+        db.session.execute(statement)
+    commit()
+    if assign_id is not None:
+      invalidate(cls, [{'movie_id': movie_id, 'actor_id': actor_id}])
+    return assign_id
 
   def format(self):
     return {
       'id': self.id,
       'movie_id': self.movie_id,
       'actor_id': self.actor_id}
+
+
+'''
+Change
+One row per insert, update or delete of an actor, movie or assign,
+written by the triggers below in the transaction of the write: the feed
+of GET /changes, tombstones included. On PostgreSQL txid is the id of
+the writing transaction (0 on SQLite, where writes are serial), see
+changes_since.
+'''
+class Change(db.Model):
+  __tablename__ = 'Change'
+  __table_args__ = (
+    db.Index('ix_Change_txid_id', 'txid', 'id'),
+  )
+
+  id = Column(db.Integer, primary_key=True)
+  txid = Column(db.BigInteger, nullable=False, default=0, server_default='0')
+  entity = Column(String, nullable=False)
+  entity_id = Column(db.Integer, nullable=False)
+  deleted = Column(db.Boolean, nullable=False, default=False)
+
+
+'''
+Movie.cast_count and Actor.movie_count are kept by triggers on Assign:
+every insert and delete of an assign, the batch ones and the ON DELETE
+CASCADE of actors and movies included, updates both counts in its own
+transaction. Migration a9d3e5f7b102 creates the same triggers.
+'''
+ASSIGN_COUNT_TRIGGERS = {
+  'sqlite': [
+    'CREATE TRIGGER assign_counts_insert AFTER INSERT ON "Assign" BEGIN '
+    'UPDATE "Movie" SET cast_count = cast_count + 1 WHERE id = NEW.movie_id; '
+    'UPDATE "Actor" SET movie_count = movie_count + 1 WHERE id = NEW.actor_id; END',
+    'CREATE TRIGGER assign_counts_delete AFTER DELETE ON "Assign" BEGIN '
+    'UPDATE "Movie" SET cast_count = cast_count - 1 WHERE id = OLD.movie_id; '
+    'UPDATE "Actor" SET movie_count = movie_count - 1 WHERE id = OLD.actor_id; END',
+    'CREATE TRIGGER assign_counts_update AFTER UPDATE OF movie_id, actor_id ON "Assign" BEGIN '
+    'UPDATE "Movie" SET cast_count = cast_count - 1 WHERE id = OLD.movie_id; '
+    'UPDATE "Actor" SET movie_count = movie_count - 1 WHERE id = OLD.actor_id; '
+    'UPDATE "Movie" SET cast_count = cast_count + 1 WHERE id = NEW.movie_id; '
+    'UPDATE "Actor" SET movie_count = movie_count + 1 WHERE id = NEW.actor_id; END',
+  ],
+  'postgresql': [
+    'CREATE OR REPLACE FUNCTION assign_counts() RETURNS trigger AS $$ BEGIN '
+    "IF TG_OP IN ('DELETE', 'UPDATE') THEN "
+    'UPDATE "Movie" SET cast_count = cast_count - 1 WHERE id = OLD.movie_id; '
+    'UPDATE "Actor" SET movie_count = movie_count - 1 WHERE id = OLD.actor_id; '
+    'END IF; '
+    "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+    'UPDATE "Movie" SET cast_count = cast_count + 1 WHERE id = NEW.movie_id; '
+    'UPDATE "Actor" SET movie_count = movie_count + 1 WHERE id = NEW.actor_id; '
+    'END IF; '
+    'RETURN NULL; END $$ LANGUAGE plpgsql',
+    'CREATE TRIGGER assign_counts AFTER INSERT OR DELETE OR UPDATE OF movie_id, actor_id '
+    'ON "Assign" FOR EACH ROW EXECUTE PROCEDURE assign_counts()',
+  ],
+}
+
+for dialect, statements in ASSIGN_COUNT_TRIGGERS.items():
+  for statement in statements:
+    event.listen(Assign.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
+
+
+'''
+Every insert and delete of Actor, Movie and Assign, and every update
+of their FIELDS, records a Change in the same transaction, created by
+migration b6e2d8f4a719 as well. Updates of the counts alone are not
+changes of their own: the Assign changes tell about them.
+'''
+RECORD_CHANGE = DDL(
+  'CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$ BEGIN '
+  'INSERT INTO "Change" (txid, entity, entity_id, deleted) VALUES (txid_current(), TG_TABLE_NAME, '
+  "CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END, TG_OP = 'DELETE'); "
+  'RETURN NULL; END $$ LANGUAGE plpgsql')
+event.listen(db.metadata, 'before_create', RECORD_CHANGE.execute_if(dialect='postgresql'))
+
+
+def change_triggers(model):
+  """{dialect: statements} creating the triggers recording the changes of `model`
+  """
+  table = model.__tablename__
+  columns = ', '.join(field for field in model.FIELDS if field != 'id')
+  sqlite = [
+    'CREATE TRIGGER "{0}_{1}_change" AFTER {2} ON "{0}" BEGIN '
+    'INSERT INTO "Change" (txid, entity, entity_id, deleted) VALUES (0, \'{0}\', {3}.id, {4}); END'
+    .format(table, name, operation, row, deleted)
+    for name, operation, row, deleted in (
+      ('insert', 'INSERT', 'NEW', 0), ('update', 'UPDATE OF ' + columns, 'NEW', 0), ('delete', 'DELETE', 'OLD', 1))]
+  postgresql = [
+    'CREATE TRIGGER "{0}_change" AFTER INSERT OR DELETE OR UPDATE OF {1} ON "{0}" '
+    'FOR EACH ROW EXECUTE PROCEDURE record_change()'.format(table, columns)]
+  return {'sqlite': sqlite, 'postgresql': postgresql}
+
+
+for model in (Actor, Movie, Assign):
+  for dialect, statements in change_triggers(model).items():
+    for statement in statements:
+      event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
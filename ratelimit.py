@@ -0,0 +1,178 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+from serialization import pack, unpack
+
+
+def parse_limit(text):
+    """'10/50' -> (10.0, 50): 10 requests a second, in bursts of up to 50
+    """
+    rate, _, burst = text.partition('/')
+    return float(rate), int(burst or max(1, math.ceil(float(rate))))
+
+
+def parse_limits(text):
+    """'search_rows=2/10,batch_assign=1/5' -> {endpoint: (rate, burst)}
+    """
+    limits = {}
+    for item in filter(None, (item.strip() for item in text.split(','))):
+        endpoint, _, limit = item.partition('=')
+        limits[endpoint.strip()] = parse_limit(limit.strip())
+    return limits
+
+
+'''
+take_token(state, now, rate, burst)
+    token bucket refilled with `rate` tokens a second up to `burst`:
+    (state after taking a token, 0) when there is one, otherwise
+    (state, seconds until there is one). `state` is (tokens, updated at),
+    None for a full bucket.
+'''
+def take_token(state, now, rate, burst):
+    tokens, updated_at = state if state is not None else (burst, now)
+    tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+'''
+LocalBuckets
+Buckets of this worker only, the `maxsize` most recently used ones:
+a bucket dropped to make room starts again full.
+'''
+class LocalBuckets:
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        with self._lock:
+            state, retry_after = take_token(self._buckets.get(key), time.monotonic(), rate, burst)
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+'''
+SharedBuckets
+Buckets shared by every worker, in anything with the get/set(ex=, nx=)
+/delete methods of a redis.Redis client. A bucket is read and written
+under a lock entry of its own; a request that cannot get the lock
+within `lock_wait` seconds goes through rather than wait any longer.
+'''
+class SharedBuckets:
+    def __init__(self, client, prefix='capstone:ratelimit:', lock_ttl=1, lock_wait=0.1, poll_interval=0.005):
+        self.client = client
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.poll_interval = poll_interval
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        try:
+            tokens, updated_at = unpack(value)
+            return float(tokens), float(updated_at)
+        except (TypeError, ValueError):
+            # unreadable, e.g. left by an older release: a full bucket
+            return None
+
+    def take(self, key, rate, burst):
+        lock = self.prefix + 'lock:' + key
+        deadline = time.monotonic() + self.lock_wait
+        while not self.client.set(lock, 1, ex=self.lock_ttl, nx=True):
+            if time.monotonic() >= deadline:
+                return 0
+            time.sleep(self.poll_interval)
+        try:
+            state, retry_after = take_token(self.get(key), time.time(), rate, burst)
+            # a bucket left alone this long is full again
+            self.client.set(self.prefix + key, pack(state), ex=max(1, math.ceil(burst / rate)))
+            return retry_after
+        finally:
+            self.client.delete(lock)
+
+
+def make_store(url, maxsize=100000):
+    if not url or url == 'none':
+        return None
+    if url == 'local':
+        return LocalBuckets(maxsize)
+    import redis
+    return SharedBuckets(redis.Redis.from_url(url))
+
+
+'''
+Limiter
+Takes a token per request from the bucket of its client. The endpoints
+of RATE_LIMITS have buckets of their own; the other endpoints share one
+bucket per client, of RATE_LIMIT. A rate of 0 means no limit.
+'''
+class Limiter:
+    def __init__(self, store, default, limits=None, proxies=0):
+        self.store = store
+        self.default = default
+        self.limits = limits or {}
+        self.proxies = proxies
+
+    def client_address(self):
+        # behind `proxies` proxies, the address the farthest one saw
+        route = request.access_route
+        if self.proxies and len(route) >= self.proxies:
+            return route[-self.proxies]
+        return request.remote_addr
+
+    def check(self, client):
+        """Raises a 429 with Retry-After when `client` is out of tokens for the endpoint
+        """
+        limit = self.limits.get(request.endpoint)
+        scope = request.endpoint if limit is not None else '*'
+        rate, burst = limit if limit is not None else self.default
+        if rate <= 0:
+            return
+        retry_after = self.store.take('{} {}'.format(scope, client), rate, burst)
+        if retry_after > 0:
+            raise TooManyRequests(retry_after=math.ceil(retry_after))
+
+    def check_address(self):
+        self.check('ip:' + str(self.client_address()))
+
+
+def before_request():
+    # routes behind requires_auth are limited per token subject once it is
+    # verified, per address when it is not
+    limiter = current_app.extensions.get('ratelimit')
+    view = current_app.view_functions.get(request.endpoint)
+    if limiter is None or view is None or getattr(view, 'requires_auth', False):
+        return
+    limiter.check_address()
+
+
+def init_app(app, store=None):
+    """Limits the request rate of `app` with the store configured by RATE_LIMIT_URL/SIZE,
+    when RATE_LIMIT or RATE_LIMITS set any limit
+    """
+    if app.config['RATE_LIMIT'][0] <= 0 and not app.config['RATE_LIMITS']:
+        return None
+    if store is None:
+        store = make_store(app.config['RATE_LIMIT_URL'], app.config['RATE_LIMIT_SIZE'])
+    if store is None:
+        return None
+    limiter = app.extensions['ratelimit'] = Limiter(
+        store, app.config['RATE_LIMIT'], app.config['RATE_LIMITS'], app.config['RATE_LIMIT_PROXIES'])
+    app.before_request(before_request)
+    return limiter
@@ -0,0 +1,136 @@
+import base64
+import gzip
+import json
+
+from flask import current_app, request
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = 'application/json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+_flask_encoder = JSONEncoder()
+
+
+def default(value):
+    """Encodes what the fast encoders do not know, the way Flask's jsonify did:
+    datetimes become HTTP dates, e.g. "Thu, 01 Jul 2021 04:15:00 GMT"
+    """
+    return _flask_encoder.default(value)
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+
+    def dumps(value):
+        return orjson.dumps(value, default=default, option=_OPTIONS)
+else:
+    def dumps(value):
+        return (json.dumps(value, default=default, separators=(',', ':')) + '\n').encode()
+
+
+def _pack_default(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    return default(value)
+
+
+def _unpack_object(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+'''
+pack(value) / unpack(data)
+    the plain data kept in the shared stores (cached responses, idempotency
+    records, rate limit buckets) as JSON, bytes included; unlike pickle,
+    reading an entry never runs code. unpack raises ValueError on data it
+    did not produce.
+'''
+def pack(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=_pack_default)
+    return json.dumps(value, default=_pack_default, separators=(',', ':')).encode()
+
+
+def unpack(data):
+    try:
+        return json.loads(data, object_hook=_unpack_object)
+    except TypeError as error:
+        raise ValueError(error)
+
+
+def packb(value):
+    return msgpack.packb(value, default=default, use_bin_type=True)
+
+
+def response_mimetype():
+    """JSON unless the client prefers MessagePack in its Accept header
+    """
+    if msgpack is None:
+        return JSON
+    return request.accept_mimetypes.best_match((JSON,) + MSGPACK_TYPES, JSON)
+
+
+'''
+jsonify(*args, **kwargs)
+    drop-in for flask.jsonify, encoding with orjson when installed and
+    answering with MessagePack when the client asks for it
+'''
+def jsonify(*args, **kwargs):
+    value = args[0] if len(args) == 1 else (args or kwargs)
+    mimetype = response_mimetype()
+    body = dumps(value) if mimetype == JSON else packb(value)
+    return current_app.response_class(body, mimetype=mimetype)
+
+
+def content_encoding():
+    return request.accept_encodings.best_match(('br', 'gzip') if brotli is not None else ('gzip',))
+
+
+def compress(response):
+    """Compresses the bodies of at least COMPRESS_MIN_SIZE bytes with brotli or gzip
+    """
+    if response.mimetype == JSON or response.mimetype in MSGPACK_TYPES:
+        response.vary.add('Accept')
+    if (response.is_streamed or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = content_encoding()
+    if encoding is None:
+        return response
+    if encoding == 'br':
+        body = brotli.compress(body, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+    else:
+        body = gzip.compress(body, current_app.config['COMPRESS_GZIP_LEVEL'])
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # the compressed bytes differ from the ones the strong ETag was computed on
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress)
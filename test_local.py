@@ -4,10 +4,30 @@ import unittest
 import requests
 import time
 import json
+import gzip
+import calendar
+import logging
+import re
+import runpy
+import tempfile
+import threading
 
 from app import create_app
-from models import setup_db
-from flask_sqlalchemy import SQLAlchemy
+from models import db, engine_options, pool_stats, bulk_insert, bulk_update, encode_cursor, savepoint, InstrumentedQueuePool, Actor, Movie, Assign
+from flask import abort, request
+from serialization import jsonify
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+import sqlite3
+from auth.auth import token_cache, verify_decode_jwt
+from auth.jwks import JWKSStore
+from auth.token_cache import VerifiedTokenCache
+from cache import SharedBackend
+from idempotency import LocalStore, SharedStore
+import benchmark
+import ratelimit
+import serialization
+from auth.testing import LocalSigner
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
@@ -17,18 +37,14 @@ class TriviaTestCase(unittest.TestCase):
     director_token = headers={'Authorization':"Bearer {}".format(os.environ['DIRECTOR'])}
     producer_token = headers={'Authorization':"Bearer {}".format(os.environ['PRODUCER'])}
 
+    @classmethod
+    def setUpClass(cls):
+        # create the missing tables once, not before every test
+        create_app({'CREATE_TABLES': True})
+
     def setUp(self):
         self.app = create_app()
         self.client = self.app.test_client
-        self.database_path = os.environ['DATABASE_URL']
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
     
     def tearDown(self):
         """Executed after reach test"""
@@ -267,6 +283,1274 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 403)
     
+def calendar_timestamp(date_time):
+    return int(calendar.timegm(date_time.timetuple()))
+
+
+# one key for every test case, generating it is slow
+SIGNER = LocalSigner()
+
+
+class QueryCounter:
+    """Counts the SQL statements sent to the engine of an app"""
+
+    def __init__(self, app):
+        self.engine = db.get_engine(app)
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+class LocalAppTestCase(unittest.TestCase):
+    """Base of the cases running the app on in-memory sqlite, with tokens minted by SIGNER"""
+
+    signer = SIGNER
+
+    def make_app(self, **config):
+        return create_app(dict({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'JWKS_SOURCE': self.signer.load_jwks}, **config))
+
+    def setUp(self):
+        self.app = self.make_app()
+        self.client = self.app.test_client()
+
+
+class CastQueryTestCase(LocalAppTestCase):
+    """The cast of a movie is loaded in a constant number of queries"""
+
+    def make_app(self, **config):
+        app = super().make_app(**config)
+        with app.app_context():
+            movie = Movie(title='Coco', release_date=datetime(2017, 11, 22))
+            db.session.add(movie)
+            db.session.add_all([Actor(name='actor {}'.format(i), age=30, gender='male') for i in range(20)])
+            db.session.flush()
+            db.session.add_all([Assign(movie_id=movie.id, actor_id=i) for i in range(1, 21)])
+            db.session.commit()
+        return app
+
+    def assert_cast_queries(self, strategy, expected):
+        app = self.make_app(CAST_LOADING_STRATEGY=strategy)
+        with QueryCounter(app) as counter:
+            res = app.test_client().get("/movies/1/actors")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["total_actors"], 20)
+        self.assertEqual(counter.count, expected)
+
+    def test_joined_cast_single_query(self):
+        self.assert_cast_queries('joined', 1)
+
+    def test_selectin_cast_two_queries(self):
+        self.assert_cast_queries('selectin', 2)
+
+    def test_subquery_cast_two_queries(self):
+        self.assert_cast_queries('subquery', 2)
+
+    def test_movies_page_embeds_casts(self):
+        app = self.make_app(CAST_LOADING_STRATEGY='selectin')
+        with app.app_context():
+            db.session.add_all([Movie(title='Cars', release_date=datetime(2006, 6, 9)),
+                                Movie(title='Dune', release_date=datetime(2024, 3, 1))])
+            db.session.add_all([Assign(movie_id=2, actor_id=1), Assign(movie_id=2, actor_id=20)])
+            db.session.commit()
+        with QueryCounter(app) as counter:
+            res = app.test_client().get("/movies?include=actors&total=false")
+        data = json.loads(res.data)
+        # the page, then every cast of it at once
+        self.assertEqual(counter.count, 2)
+        self.assertEqual([movie['actor_ids'] for movie in data['movies']], [list(range(1, 21)), [1, 20], []])
+        self.assertEqual([actor['id'] for actor in data['actors']], list(range(1, 21)))
+        self.assertEqual(data['actors'][0], {'id': 1, 'name': 'actor 0', 'age': 30, 'gender': 'male'})
+        data = json.loads(app.test_client().get("/actors/1/movies?include=actors").data)
+        self.assertEqual([movie['actor_ids'] for movie in data['movies']], [list(range(1, 21)), [1, 20]])
+        self.assertEqual(app.test_client().get("/actors?include=actors").status_code, 400)
+
+    def test_deleting_movie_removes_assignments(self):
+        app = self.make_app(CAST_LOADING_STRATEGY='selectin')
+        with app.app_context():
+            Movie.query.get(1).delete()
+            self.assertEqual(Assign.query.count(), 0)
+            self.assertEqual(Actor.query.count(), 20)
+
+
+class PaginationTestCase(LocalAppTestCase):
+    """Keyset pages and column projection of /actors and /movies"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add_all([Actor(name='actor {}'.format(i), age=20 + i, gender='female') for i in range(5)])
+            db.session.add(Movie(title='Coco', release_date=datetime(2017, 11, 22)))
+            db.session.commit()
+
+    def test_actors_pages(self):
+        data = json.loads(self.client.get("/actors?limit=2").data)
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 2])
+        self.assertEqual(data['next'], 2)
+        self.assertEqual(data['total_actors'], 5)
+        data = json.loads(self.client.get("/actors?limit=2&after=4").data)
+        self.assertEqual([actor['id'] for actor in data['actors']], [5])
+        self.assertIsNone(data['next'])
+
+    def test_fields_projection(self):
+        data = json.loads(self.client.get("/actors?fields=name&total=false").data)
+        self.assertEqual(data['actors'][0], {'id': 1, 'name': 'actor 0'})
+        self.assertNotIn('total_actors', data)
+        data = json.loads(self.client.get("/movies?fields=title,release_date").data)
+        self.assertEqual(data['movies'][0]['release_date'], 'Wed, 22 Nov 2017 00:00:00 GMT')
+
+    def test_bad_page_args_400(self):
+        self.assertEqual(self.client.get("/actors?fields=password").status_code, 400)
+        self.assertEqual(self.client.get("/actors?limit=abc").status_code, 400)
+        self.assertEqual(self.client.get("/movies?limit=0").status_code, 400)
+
+    def test_export_ndjson(self):
+        res = self.client.get("/actors/export?fields=name")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = res.data.decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0]), {'id': 1, 'name': 'actor 0'})
+
+    def test_export_gzip(self):
+        res = self.client.get("/movies/export", headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(res.data).decode().splitlines()
+        self.assertEqual(json.loads(lines[0])['title'], 'Coco')
+
+    def test_total_is_cached(self):
+        self.client.get("/actors")
+        with QueryCounter(self.app) as counter:
+            data = json.loads(self.client.get("/actors?limit=3").data)
+        self.assertEqual(data['total_actors'], 5)
+        self.assertEqual(counter.count, 1)
+
+
+class FilterSortTestCase(LocalAppTestCase):
+    """Filters and sort keys of /actors and /movies, compiled into SQL"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add_all([
+                Actor(name='Ann', age=25, gender='female'),
+                Actor(name='Bob', age=25, gender='male'),
+                Actor(name='Cid', age=40, gender='male'),
+                Actor(name='Dee', age=29, gender='female'),
+                Actor(name='Eve', age=None, gender='female'),
+                Actor(name='Fay', age=31, gender='female')])
+            db.session.add_all([
+                Movie(title='Coco', release_date=datetime(2017, 11, 22)),
+                Movie(title='Cars', release_date=datetime(2006, 6, 9)),
+                Movie(title='100% Wolf', release_date=datetime(2020, 6, 26)),
+                Movie(title='Dune', release_date=datetime(2024, 3, 1))])
+            db.session.commit()
+
+    def get(self, path):
+        res = self.client.get(path)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def walk(self, path, key):
+        names, after = [], None
+        while True:
+            data = self.get(path + ('&after={}'.format(after) if after is not None else ''))
+            names += [row['name' if key == 'actors' else 'title'] for row in data[key]]
+            after = data['next']
+            if after is None:
+                return names
+
+    def test_actor_filters(self):
+        data = self.get('/actors?gender=female&age_max=29')
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Ann', 'Dee'])
+        self.assertEqual(data['total_actors'], 2)
+        data = self.get('/actors?age_min=26&age_max=35')
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Dee', 'Fay'])
+
+    def test_movie_filters(self):
+        data = self.get('/movies?title_prefix=C')
+        self.assertEqual(sorted(movie['title'] for movie in data['movies']), ['Cars', 'Coco'])
+        data = self.get('/movies?title_prefix=100%25')
+        self.assertEqual([movie['title'] for movie in data['movies']], ['100% Wolf'])
+        self.assertEqual(self.get('/movies?title_prefix=1%25')['movies'], [])
+        data = self.get('/movies?release_date_from={}&release_date_to={}'.format(
+            calendar_timestamp(datetime(2024, 1, 1)), calendar_timestamp(datetime(2024, 12, 31))))
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Dune'])
+
+    def test_sorted_pages_walk_ties_and_nulls(self):
+        self.assertEqual(self.walk('/actors?sort=age&limit=2', 'actors'),
+                         ['Ann', 'Bob', 'Dee', 'Fay', 'Cid', 'Eve'])
+        self.assertEqual(self.walk('/actors?sort=-age&limit=2', 'actors'),
+                         ['Eve', 'Cid', 'Fay', 'Dee', 'Bob', 'Ann'])
+        self.assertEqual(self.walk('/movies?sort=-release_date&limit=1', 'movies'),
+                         ['Dune', '100% Wolf', 'Coco', 'Cars'])
+        self.assertEqual(self.walk('/actors?sort=-id&limit=4', 'actors'),
+                         ['Fay', 'Eve', 'Dee', 'Cid', 'Bob', 'Ann'])
+
+    def test_sort_returns_sort_key(self):
+        data = self.get('/actors?sort=age&fields=name&limit=1')
+        self.assertEqual(data['actors'][0], {'id': 1, 'name': 'Ann', 'age': 25})
+
+    def test_bad_filter_and_sort_args_400(self):
+        self.assertEqual(self.client.get('/actors?sort=gender').status_code, 400)
+        self.assertEqual(self.client.get('/actors?age_min=old').status_code, 400)
+        self.assertEqual(self.client.get('/actors?sort=age&after=3').status_code, 400)
+        self.assertEqual(self.client.get('/movies?sort=release_date&after=WzEsMl0').status_code, 400)
+        for sort, cursor in (('name', [[1], 1]), ('name', [5, 1]), ('age', ['x', 1]), ('age', [30, True])):
+            path = '/actors?sort={}&after={}'.format(sort, encode_cursor(cursor))
+            self.assertEqual(self.client.get(path).status_code, 400)
+
+    def test_sort_uses_index(self):
+        with self.app.app_context():
+            plan = db.session.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM "Actor" WHERE age > 25 ORDER BY age, id').fetchall()
+        self.assertIn('ix_Actor_age', ' '.join(str(row) for row in plan))
+
+
+class SearchTestCase(LocalAppTestCase):
+    """GET /search, on its SQLite fallback"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add_all([Actor(name=name, age=30, gender='male')
+                                for name in ('Tom Hanks', 'Tommy Lee Jones', 'Ken Watanabe', 'Atom_Ant')])
+            db.session.add_all([Movie(title=title, release_date=datetime(2020, 1, 1))
+                                for title in ('Cast Away', 'The Tomb', 'Tomorrowland')])
+            db.session.commit()
+
+    def search(self, query):
+        res = self.client.get('/search?' + query)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_word_prefixes_ranked(self):
+        data = self.search('q=tom')
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tom Hanks', 'Tommy Lee Jones'])
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Tomorrowland', 'The Tomb'])
+        data = self.search('q=Jones%20to&type=actors')
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tommy Lee Jones'])
+        self.assertNotIn('movies', data)
+
+    def test_pages(self):
+        data = self.search('q=to&type=actors&limit=1')
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tom Hanks'])
+        self.assertEqual(data['next'], 1)
+        data = self.search('q=to&type=actors&limit=1&offset=1')
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tommy Lee Jones'])
+        self.assertIsNone(data['next'])
+
+    def test_wildcards_are_literal(self):
+        self.assertEqual(self.search('q=_&type=actors')['actors'], [])
+        self.assertEqual(self.search('q=%25')['actors'], [])
+
+    def test_bad_search_args_400(self):
+        self.assertEqual(self.client.get('/search').status_code, 400)
+        self.assertEqual(self.client.get('/search?q=tom&type=assigns').status_code, 400)
+        self.assertEqual(self.client.get('/search?q=tom&offset=-1').status_code, 400)
+
+
+class BatchTestCase(LocalAppTestCase):
+    """Bulk writes of actors, movies and assignments"""
+
+    def setUp(self):
+        super().setUp()
+        self.producer = self.signer.headers([
+            'post:actor', 'patch:actor', 'delete:actor', 'post:movie', 'post:assign', 'delete:assign'])
+
+    def test_batch_create_actors(self):
+        actors = [{'name': 'actor {}'.format(i), 'age': 30, 'gender': 'male'} for i in range(25)]
+        actors.insert(3, {'age': 20})
+        res = self.client.post("/actors:batch?chunk_size=10", json={'create': actors}, headers=self.producer)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['created']), 26)
+        self.assertEqual(data['created'][3], {'index': 3, 'success': False, 'error': 422})
+        self.assertEqual(data['created'][4], {'index': 4, 'success': True, 'id': 4})
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 25)
+
+    def test_batch_rejects_wrong_types(self):
+        actors = [{'name': 'x', 'age': {'a': 1}}, {'name': 'y', 'age': 'abc'}, {'name': 'z', 'age': True},
+                  {'name': 1}, {'name': 'Jane', 'gender': None}]
+        res = self.client.post("/actors:batch", json={'create': actors}, headers=self.producer)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result.get('error') for result in json.loads(res.data)['created']],
+                         [422, 422, 422, 422, None])
+
+    def test_batch_update_and_delete_actors(self):
+        self.client.post("/actors:batch", json={'create': [{'name': 'Jane', 'age': 26}, {'name': 'Tom'}]},
+                         headers=self.producer)
+        res = self.client.post("/actors:batch", json={
+            'update': [{'id': 1, 'age': 27}, {'id': 100, 'age': 1}, {'id': 2, 'name': None}],
+            'delete': [2, 200]}, headers=self.producer)
+        data = json.loads(res.data)
+        self.assertEqual([result['success'] for result in data['edited']], [True, False, False])
+        self.assertEqual([result.get('error') for result in data['deleted']], [None, 404])
+        with self.app.app_context():
+            jane = Actor.query.get(1)
+            self.assertEqual((jane.name, jane.age), ('Jane', 27))
+            self.assertIsNone(Actor.query.get(2))
+
+    def test_batch_requires_every_permission(self):
+        headers = self.signer.headers(['post:actor'])
+        res = self.client.post("/actors:batch", json={'create': [{'name': 'Jane'}], 'delete': [1]}, headers=headers)
+        self.assertEqual(res.status_code, 403)
+
+    def test_batch_assign(self):
+        self.client.post("/actors:batch", json={'create': [{'name': 'Jane'}, {'name': 'Tom'}]}, headers=self.producer)
+        self.client.post("/movies:batch", json={'create': [{'title': 'Coco', 'release_date': 1511308800}]},
+                         headers=self.producer)
+        res = self.client.post("/movies/1/actors:batch", json={'create': [1, 2, 2, 300]}, headers=self.producer)
+        data = json.loads(res.data)
+        self.assertEqual([result.get('id') for result in data['created']], [1, 2, 2, None])
+        res = self.client.post("/movies/1/actors:batch", json={'create': [1], 'delete': [2]}, headers=self.producer)
+        data = json.loads(res.data)
+        self.assertEqual(data['created'][0]['id'], 1)
+        self.assertEqual(data['deleted'][0]['id'], 2)
+        data = json.loads(self.client.get("/movies/1/actors").data)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Jane'])
+        self.assertEqual(self.client.post("/movies/9/actors:batch", json={'create': [1]},
+                                          headers=self.producer).status_code, 404)
+
+
+class StandInRedis:
+    """The few redis.Redis methods SharedBackend, SharedStore and SharedBuckets use, kept in a dict"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+
+class ResponseCacheTestCase(LocalAppTestCase):
+    """GET responses are served from the cache until a write invalidates them"""
+
+    def make_app(self, **config):
+        app = super().make_app(**config)
+        with app.app_context():
+            db.session.add_all([Actor(name='Jane', age=26, gender='female'), Actor(name='Tom', age=25, gender='male')])
+            db.session.add_all([Movie(title='Coco', release_date=datetime(2017, 11, 22)),
+                                Movie(title='Up', release_date=datetime(2009, 5, 29))])
+            db.session.add_all([Assign(movie_id=1, actor_id=1), Assign(movie_id=2, actor_id=2)])
+            db.session.commit()
+        return app
+
+    def test_hit_skips_database(self):
+        self.client.get("/movies/1/actors")
+        with QueryCounter(self.app) as counter:
+            res = self.client.get("/movies/1/actors")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(counter.count, 0)
+
+    def test_write_invalidates(self):
+        self.assertEqual(json.loads(self.client.get("/actors").data)['total_actors'], 2)
+        self.client.post("/actors", json={'name': 'Ken'}, headers=self.signer.headers(['post:actor']))
+        self.assertEqual(json.loads(self.client.get("/actors").data)['total_actors'], 3)
+
+    def test_assigning_twice_returns_existing_assign(self):
+        headers = self.signer.headers(['post:assign'])
+        first = json.loads(self.client.post("/movies/1/actors/2", headers=headers).data)
+        second = json.loads(self.client.post("/movies/1/actors/2", headers=headers).data)
+        self.assertEqual(first['created'], second['created'])
+        res = self.client.delete("/movies/1/actors/2", headers=self.signer.headers(['delete:assign']))
+        self.assertEqual(res.status_code, 200)
+
+    def test_invalidation_is_per_movie(self):
+        self.client.get("/movies/1/actors")
+        self.client.get("/movies/2/actors")
+        self.client.post("/movies/1/actors/2", headers=self.signer.headers(['post:assign']))
+        with QueryCounter(self.app) as counter:
+            self.client.get("/movies/2/actors")
+        self.assertEqual(counter.count, 0)
+        data = json.loads(self.client.get("/movies/1/actors").data)
+        self.assertEqual(data['total_actors'], 2)
+
+    def test_etag_revalidation(self):
+        res = self.client.get("/movies")
+        etag = res.headers['ETag']
+        res = self.client.get("/movies", headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.client.delete("/movies/2", headers=self.signer.headers(['delete:movie']))
+        res = self.client.get("/movies", headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_shared_backend(self):
+        redis = StandInRedis()
+        apps = [self.make_app(RESPONSE_CACHE_BACKEND=SharedBackend(redis)) for _ in range(2)]
+        apps[0].test_client().get("/actors")
+        with QueryCounter(apps[1]) as counter:
+            apps[1].test_client().get("/actors")
+        self.assertEqual(counter.count, 0)
+        apps[0].test_client().delete("/actors/2", headers=self.signer.headers(['delete:actor']))
+        with QueryCounter(apps[1]) as counter:
+            apps[1].test_client().get("/actors")
+        self.assertGreater(counter.count, 0)
+
+    def test_shared_entries_are_json(self):
+        redis = StandInRedis()
+        app = self.make_app(RESPONSE_CACHE_BACKEND=SharedBackend(redis))
+        body = app.test_client().get("/actors").data
+        value = next(value for key, value in redis.data.items() if ':response:' in key)
+        self.assertEqual(json.loads(value)['mimetype'], 'application/json')
+        self.assertEqual(serialization.unpack(value)['body'], body)
+        # anything else found in the store is a miss, never code to run
+        for key in list(redis.data):
+            if ':response:' in key:
+                redis.data[key] = b'cos\nsystem\n(S"exit 1"\ntR.'
+        self.assertEqual(app.test_client().get("/actors").data, body)
+
+
+class FilmographyTestCase(LocalAppTestCase):
+    """GET /actors/<id>/movies"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add_all([Actor(name='Jane', age=26, gender='female'), Actor(name='Tom', age=25, gender='male')])
+            db.session.add_all([Movie(title='movie {}'.format(year), release_date=datetime(year, 1, 1))
+                                for year in range(2000, 2010)])
+            db.session.flush()
+            db.session.add_all([Assign(movie_id=id, actor_id=1) for id in range(1, 11, 2)])
+            db.session.commit()
+
+    def test_movies_of_actor(self):
+        with QueryCounter(self.app) as counter:
+            data = json.loads(self.client.get("/actors/1/movies?limit=3").data)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1, 3, 5])
+        data = json.loads(self.client.get("/actors/1/movies?after={}".format(data['next'])).data)
+        self.assertEqual([movie['id'] for movie in data['movies']], [7, 9])
+        self.assertIsNone(data['next'])
+
+    def test_release_date_range(self):
+        start = calendar_timestamp(datetime(2002, 1, 1))
+        end = calendar_timestamp(datetime(2006, 1, 1))
+        data = json.loads(self.client.get(
+            "/actors/1/movies?fields=title&release_date_from={}&release_date_to={}".format(start, end)).data)
+        self.assertEqual([movie['title'] for movie in data['movies']], ['movie 2002', 'movie 2004', 'movie 2006'])
+
+    def test_actor_without_movies(self):
+        res = self.client.get("/actors/2/movies")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movies'], [])
+        self.assertEqual(self.client.get("/actors/3/movies").status_code, 404)
+
+
+class DatabaseConfigTestCase(unittest.TestCase):
+    """Pool settings, pool metrics and the read replica bind"""
+
+    def test_engine_options(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        app.config.update(DB_POOL_SIZE=2, DB_POOL_PRE_PING='false', DB_STATEMENT_TIMEOUT_MS=500)
+        options = engine_options(app, 'postgresql://localhost/capstone')
+        self.assertEqual(options['pool_size'], 2)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=500'})
+        self.assertEqual(engine_options(app, 'sqlite://'), {})
+
+    def test_pool_metrics(self):
+        pool = InstrumentedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.05)
+        connection = pool.connect()
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        stats = pool.stats()
+        self.assertEqual((stats['checkouts'], stats['timeouts'], stats['checked_out']), (2, 1, 1))
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0.05)
+        connection.close()
+
+    def test_get_requests_read_from_replica(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'DATABASE_REPLICA_URL': 'sqlite://',
+            'RESPONSE_CACHE_URL': 'none'})
+        with app.app_context():
+            db.Model.metadata.create_all(db.get_engine(app, 'replica'))
+            Actor(name='Jane', age=26, gender='female').insert()
+            self.assertEqual(pool_stats(app), {})
+        data = json.loads(app.test_client().get("/actors").data)
+        self.assertEqual(data['total_actors'], 0)
+        with app.test_request_context('/actors', method='POST'):
+            self.assertEqual(Actor.query.count(), 1)
+
+    def test_cache_is_filled_from_primary(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DATABASE_REPLICA_URL': 'sqlite://'})
+        with app.app_context():
+            db.Model.metadata.create_all(db.get_engine(app, 'replica'))
+            Actor(name='Jane', age=26, gender='female').insert()
+        # the replica lags behind: what gets cached comes from the primary
+        self.assertEqual(json.loads(app.test_client().get("/actors").data)['total_actors'], 1)
+        self.assertEqual(json.loads(app.test_client().get("/actors").data)['total_actors'], 1)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """benchmark.py times every route without errors"""
+
+    def test_every_route_is_benchmarked(self):
+        report = benchmark.run(actors=20, movies=5, cast=3, requests=3, warmup=1, signer=SIGNER)
+        self.assertEqual(report['meta']['untimed_routes'], [])
+        for route, result in report['routes'].items():
+            self.assertEqual(result['errors'], 0, route)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_compare_flags_p95_regressions(self):
+        baseline = {'routes': {'GET /actors': {'p95_ms': 10.0}, 'GET /movies': {'p95_ms': 10.0}}}
+        results = {'GET /actors': {'p95_ms': 13.0}, 'GET /movies': {'p95_ms': 11.0}, 'GET /': {'p95_ms': 1.0}}
+        self.assertEqual(benchmark.compare(results, baseline, 20), [('GET /actors', 10.0, 13.0)])
+
+    def test_boot_times(self):
+        times = benchmark.boot(runs=1)
+        self.assertEqual(set(times), {'import_ms', 'create_app_ms', 'first_request_ms'})
+        self.assertEqual(benchmark.compare_boot(times, {'boot': {'import_ms': times['import_ms'] / 2}}, 20),
+                         [('boot import_ms', times['import_ms'] / 2, times['import_ms'])])
+
+    def test_unit_of_work_commits_once(self):
+        results = benchmark.unit_of_work(rows=3, requests=2)
+        self.assertEqual(results['per_write']['commits_per_request'], 7)
+        self.assertEqual(results['unit_of_work']['commits_per_request'], 1)
+
+    def test_boot_does_not_touch_the_database(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'boot-test.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path})
+        app.test_client().get('/')
+        self.assertFalse(os.path.exists(path))
+        create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'CREATE_TABLES': True})
+        self.assertTrue(os.path.exists(path))
+
+
+class SerializationTestCase(LocalAppTestCase):
+    """Fast JSON, MessagePack negotiation and compressed responses"""
+
+    def make_app(self, **config):
+        return super().make_app(**dict({'COMPRESS_MIN_SIZE': 512}, **config))
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            bulk_insert(Movie, [{'title': 'movie {}'.format(i), 'release_date': datetime(2021, 7, 1, 4, 15)}
+                                for i in range(20)])
+            db.session.commit()
+
+    def test_release_date_keeps_http_date_format(self):
+        res = self.client.get('/movies?limit=1')
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(json.loads(res.data)['movies'][0]['release_date'], 'Thu, 01 Jul 2021 04:15:00 GMT')
+
+    @unittest.skipIf(serialization.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_is_negotiated(self):
+        as_json = self.client.get('/movies', headers={'Accept': 'application/json'})
+        res = self.client.get('/movies', headers={'Accept': 'application/msgpack'})
+
+        self.assertEqual(res.mimetype, 'application/msgpack')
+        self.assertIn('Accept', res.headers['Vary'])
+        self.assertEqual(serialization.msgpack.unpackb(res.data), json.loads(as_json.data))
+        again = self.client.get('/movies', headers={'Accept': 'application/json, */*'})
+        self.assertEqual(again.mimetype, 'application/json')
+
+    def test_large_bodies_are_gzipped(self):
+        plain = self.client.get('/movies')
+        res = self.client.get('/movies', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        etag, weak = res.get_etag()
+        self.assertTrue(weak)
+        revalidated = self.client.get('/movies', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': 'W/"{}"'.format(etag)})
+        self.assertEqual(revalidated.status_code, 304)
+
+    @unittest.skipIf(serialization.brotli is None, 'brotli is not installed')
+    def test_brotli_is_preferred(self):
+        res = self.client.get('/movies', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(serialization.brotli.decompress(res.data), self.client.get('/movies').data)
+
+    def test_small_bodies_are_not_compressed(self):
+        res = self.client.get('/movies?limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+
+class GunicornConfigTestCase(unittest.TestCase):
+    """gunicorn.conf.py picks the worker from the environment"""
+
+    def load(self, **env):
+        saved = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            return runpy.run_path(os.path.join(os.path.dirname(__file__), 'gunicorn.conf.py'))
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+    def test_sync_worker_by_default(self):
+        config = self.load()
+        self.assertEqual(config['worker_class'], 'sync')
+
+    def test_gevent_worker(self):
+        config = self.load(WORKER_CLASS='gevent', WORKER_CONNECTIONS='250')
+        self.assertEqual(config['worker_class'], 'gevent')
+        self.assertEqual(config['worker_connections'], 250)
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    """Signing keys are fetched once and served from memory"""
+
+    def setUp(self):
+        self.calls = 0
+        self.jwks = {'keys': [{'kid': 'a', 'kty': 'RSA', 'use': 'sig', 'n': 'n', 'e': 'e'}]}
+
+    def load(self):
+        self.calls += 1
+        return self.jwks
+
+    def test_keys_are_cached(self):
+        store = JWKSStore(self.load)
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(self.calls, 1)
+
+    def test_unknown_kid_refetches_once(self):
+        store = JWKSStore(self.load, min_refresh_interval=0)
+        store.get_key('a')
+        self.jwks = {'keys': self.jwks['keys'] + [{'kid': 'b', 'kty': 'RSA', 'use': 'sig', 'n': 'n', 'e': 'e'}]}
+        self.assertEqual(store.get_key('b')['kid'], 'b')
+        self.assertEqual(self.calls, 2)
+        self.assertIsNone(store.get_key('missing'))
+        self.assertEqual(self.calls, 3)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        store = JWKSStore(self.load, min_refresh_interval=60)
+        store.get_key('a')
+        self.assertIsNone(store.get_key('missing'))
+        self.assertIsNone(store.get_key('missing'))
+        self.assertEqual(self.calls, 1)
+
+    def test_stale_keys_are_served_while_refreshing(self):
+        store = JWKSStore(self.load, ttl=0)
+        store.get_key('a')
+        time.sleep(0.01)
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        for _ in range(100):
+            if self.calls == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.calls, 2)
+
+    def test_local_jwks_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jwks.json')
+            with open(path, 'w') as f:
+                json.dump(self.jwks, f)
+            self.assertEqual(JWKSStore(path).get_key('a')['kid'], 'a')
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """Bounded LRU of verified token payloads"""
+
+    def test_entry_evicted_at_exp(self):
+        cache = VerifiedTokenCache()
+        cache.put('t', {'exp': 100})
+        self.assertEqual(cache.get('t', now=99), {'exp': 100})
+        self.assertIsNone(cache.get('t', now=100))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = VerifiedTokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.put('a', {'exp': exp})
+        cache.put('b', {'exp': exp})
+        cache.get('a')
+        cache.put('c', {'exp': exp})
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_tokens_without_exp_are_not_cached(self):
+        cache = VerifiedTokenCache()
+        cache.put('t', {'sub': 'x'})
+        self.assertIsNone(cache.get('t'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+class LocalAuthTestCase(LocalAppTestCase):
+    """Runs the app against sqlite with tokens minted by a local key"""
+
+    def test_local_token_is_accepted(self):
+        res = self.client.post("/actors", json={'name': 'Jane', 'age': 26, 'gender': 'female'},
+                               headers=self.signer.headers(['post:actor']))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(json.loads(res.data)["created"])
+
+    def test_missing_permission_403(self):
+        res = self.client.post("/actors", json={'name': 'Jane'},
+                               headers=self.signer.headers(['post:movie']))
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(json.loads(res.data)["success"])
+
+    def test_repeated_token_is_verified_once(self):
+        token = self.signer.token(['post:actor'])
+        headers = {'Authorization': 'Bearer {}'.format(token)}
+        for name in ('Jane', 'Tom'):
+            res = self.client.post("/actors", json={'name': name}, headers=headers)
+            self.assertEqual(res.status_code, 200)
+        stats = token_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertIs(verify_decode_jwt(token), verify_decode_jwt(token))
+
+    def test_expired_token_401(self):
+        res = self.client.post("/actors", json={'name': 'Jane'},
+                               headers=self.signer.headers(['post:actor'], expires_in=-60))
+        self.assertEqual(res.status_code, 401)
+
+
+class MutationTestCase(LocalAppTestCase):
+    """Every single-row write is one statement, foreign keys answer the 404s"""
+
+    def setUp(self):
+        super().setUp()
+        self.headers = self.signer.headers([
+            'patch:actor', 'delete:actor', 'patch:movie', 'delete:movie', 'post:assign', 'delete:assign'])
+        with self.app.app_context():
+            db.session.add_all([Actor(name='Ann', age=30, gender='female'), Actor(name='Bob', age=40, gender='male')])
+            db.session.add(Movie(title='Coco', release_date=datetime(2017, 11, 22)))
+            db.session.add(Assign(movie_id=1, actor_id=1))
+            db.session.commit()
+        # verify the token once, outside of the counted requests
+        self.client.get('/actors', headers=self.headers)
+
+    def request(self, method, path, **kwargs):
+        with QueryCounter(self.app) as counter:
+            res = self.client.open(path, method=method, headers=self.headers, **kwargs)
+        return res, counter.count
+
+    def test_patch_is_one_statement(self):
+        # without If-Match, SQLite needs a second statement to read the new version (PostgreSQL: RETURNING)
+        self.headers['If-Match'] = '"1"'
+        res, count = self.request('PATCH', '/actors/2', json={'name': 'Bo', 'age': 41, 'gender': 'male'})
+        self.assertEqual(json.loads(res.data)['edited'], 2)
+        self.assertEqual(count, 1)
+        res, count = self.request('PATCH', '/movies/1', json={'title': 'Coco', 'release_date': 1625112900})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(count, 1)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.get(2).name, 'Bo')
+            self.assertEqual(Movie.query.get(1).release_date, datetime(2021, 7, 1, 4, 15))
+
+    def test_delete_is_one_statement_and_cascades(self):
+        res, count = self.request('DELETE', '/actors/1')
+        self.assertEqual(json.loads(res.data)['deleted'], 1)
+        self.assertEqual(count, 1)
+        with self.app.app_context():
+            self.assertEqual(Assign.query.count(), 0)
+        res, count = self.request('DELETE', '/movies/1')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(count, 1)
+
+    def test_assign_is_one_statement(self):
+        res, count = self.request('POST', '/movies/1/actors/2')
+        self.assertEqual(json.loads(res.data)['created'], 2)
+        self.assertEqual(count, 1)
+        res, count = self.request('DELETE', '/movies/1/actors/2')
+        self.assertEqual(json.loads(res.data)['deleted'], 2)
+
+    def test_missing_rows_404(self):
+        self.assertEqual(self.request('PATCH', '/actors/9', json={'name': 'X'})[0].status_code, 404)
+        self.assertEqual(self.request('DELETE', '/actors/9')[0].status_code, 404)
+        self.assertEqual(self.request('PATCH', '/movies/9', json={'title': 'X', 'release_date': 0})[0].status_code, 404)
+        self.assertEqual(self.request('DELETE', '/movies/9')[0].status_code, 404)
+        self.assertEqual(self.request('POST', '/movies/9/actors/1')[0].status_code, 404)
+        self.assertEqual(self.request('POST', '/movies/1/actors/9')[0].status_code, 404)
+        self.assertEqual(self.request('DELETE', '/movies/1/actors/2')[0].status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(Assign.query.count(), 1)
+
+
+class AssignCountsTestCase(LocalAppTestCase):
+    """The cast and filmography counts follow every write of Assign"""
+
+    def setUp(self):
+        super().setUp()
+        self.headers = self.signer.headers([
+            'delete:actor', 'delete:movie', 'post:assign', 'delete:assign'])
+        with self.app.app_context():
+            db.session.add_all([Actor(name='Ann', age=30, gender='female'), Actor(name='Bob', age=40, gender='male')])
+            db.session.add_all([Movie(title='Coco', release_date=datetime(2017, 11, 22)),
+                                Movie(title='Cars', release_date=datetime(2006, 6, 9))])
+            db.session.commit()
+
+    def counts(self):
+        actors = json.loads(self.client.get('/actors?include=counts').data)['actors']
+        movies = json.loads(self.client.get('/movies?include=counts').data)['movies']
+        return [actor['movie_count'] for actor in actors], [movie['cast_count'] for movie in movies]
+
+    def test_counts_follow_assigns(self):
+        self.assertEqual(self.counts(), ([0, 0], [0, 0]))
+        self.client.post('/movies/1/actors/1', headers=self.headers)
+        self.client.post('/movies/1/actors/2', headers=self.headers)
+        self.client.post('/movies/1/actors/2', headers=self.headers)
+        self.client.post('/movies/2/actors:batch', json={'create': [1, 2]}, headers=self.headers)
+        self.assertEqual(self.counts(), ([2, 2], [2, 2]))
+        self.client.delete('/movies/1/actors/2', headers=self.headers)
+        self.assertEqual(self.counts(), ([2, 1], [1, 2]))
+        # the assigns of a deleted actor go with it, ON DELETE CASCADE
+        self.client.delete('/actors/1', headers=self.headers)
+        self.assertEqual(self.counts(), ([1], [0, 1]))
+        with self.app.app_context():
+            Assign(movie_id=1, actor_id=2).insert()
+            self.assertEqual((Movie.query.get(1).cast_count, Actor.query.get(2).movie_count), (1, 2))
+
+    def test_counts_take_no_extra_query(self):
+        with QueryCounter(self.app) as counter:
+            data = json.loads(self.client.get('/movies?include=counts&fields=title').data)
+        self.assertEqual(data['movies'][0], {'title': 'Coco', 'cast_count': 0, 'id': 1})
+        # the page and its total
+        self.assertEqual(counter.count, 2)
+        self.assertNotIn('cast_count', json.loads(self.client.get('/movies').data)['movies'][0])
+        self.assertEqual(self.client.get('/movies?include=cast').status_code, 400)
+
+
+class PartialUpdateTestCase(LocalAppTestCase):
+    """PATCH writes only the given columns, conditionally on If-Match"""
+
+    def setUp(self):
+        super().setUp()
+        self.headers = self.signer.headers(['patch:actor', 'patch:movie'])
+        with self.app.app_context():
+            db.session.add(Actor(name='Ann', age=30, gender='female'))
+            db.session.add(Movie(title='Coco', release_date=datetime(2017, 11, 22)))
+            db.session.commit()
+
+    def patch(self, path, body, etag=None):
+        headers = dict(self.headers, **({'If-Match': etag} if etag else {}))
+        return self.client.patch(path, json=body, headers=headers)
+
+    def test_only_given_columns_are_written(self):
+        res = self.patch('/actors/1', {'age': 31})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"2"')
+        res = self.patch('/movies/1', {'title': 'Coco (2017)'})
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            actor = Actor.query.get(1)
+            self.assertEqual((actor.name, actor.age, actor.gender), ('Ann', 31, 'female'))
+            self.assertEqual(Movie.query.get(1).release_date, datetime(2017, 11, 22))
+
+    def test_unchanged_values_skip_the_write(self):
+        with QueryCounter(self.app) as counter:
+            res = self.patch('/actors/1', {})
+        self.assertEqual(res.headers['ETag'], '"1"')
+        self.assertEqual(counter.count, 1)
+        res = self.patch('/actors/1', {'name': 'Ann', 'age': 30})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"1"')
+
+    def test_if_match(self):
+        etag = self.client.get('/actors/1').headers['ETag']
+        self.assertEqual(self.patch('/actors/1', {'age': 31}, etag).headers['ETag'], '"2"')
+        res = self.patch('/actors/1', {'age': 32}, etag)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(self.patch('/actors/1', {'age': 32}, 'W/"2"').status_code, 412)
+        self.assertEqual(self.patch('/actors/1', {'age': 32}, '"2", "7"').status_code, 200)
+        self.assertEqual(self.patch('/actors/1', {'age': 33}, '*').status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.get(1).age, 33)
+
+    def test_get_row_revalidation(self):
+        res = self.client.get('/movies/1')
+        self.assertEqual(json.loads(res.data)['movie']['title'], 'Coco')
+        res = self.client.get('/movies/1', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(self.client.get('/movies/9').status_code, 404)
+
+    def test_invalid_patches(self):
+        self.assertEqual(self.patch('/movies/1', {'release_date': 'soon'}).status_code, 422)
+        self.assertEqual(self.patch('/actors/1', {'name': None}).status_code, 422)
+        self.assertEqual(self.patch('/actors/1', {'age': 'abc'}).status_code, 422)
+        self.assertEqual(self.patch('/actors/9', {'age': 1}).status_code, 404)
+
+
+class IdempotencyTestCase(LocalAppTestCase):
+    """Retried POSTs with an Idempotency-Key write once"""
+
+    def setUp(self):
+        super().setUp()
+        self.headers = self.signer.headers(['post:actor', 'post:movie', 'post:assign'])
+
+    def post(self, path, body=None, key='retry-1', **headers):
+        headers = dict(self.headers, **headers)
+        if key:
+            headers['Idempotency-Key'] = key
+        return self.client.post(path, json=body, headers=headers)
+
+    def test_retry_replays_the_response(self):
+        body = {'name': 'Ann', 'age': 30, 'gender': 'female'}
+        first = self.post('/actors', body)
+        with QueryCounter(self.app) as counter:
+            retry = self.post('/actors', body)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(json.loads(self.post('/actors', body, key=None).data)['created'], 2)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 2)
+
+    def test_keys_are_per_subject_and_route(self):
+        body = {'title': 'Coco', 'release_date': 1511308800}
+        self.post('/movies', body)
+        other = self.post('/movies', body, Authorization='Bearer ' + self.signer.token(['post:movie'], sub='auth0|other'))
+        self.assertNotIn('Idempotent-Replayed', other.headers)
+        self.assertEqual(json.loads(other.data)['created'], 2)
+
+    def test_key_reused_for_another_body_422(self):
+        self.post('/actors', {'name': 'Ann'})
+        self.assertEqual(self.post('/actors', {'name': 'Bob'}).status_code, 422)
+
+    def test_failures_are_not_stored(self):
+        self.assertEqual(self.post('/movies/1/actors/1').status_code, 404)
+        with self.app.app_context():
+            Actor(name='Ann', age=30, gender='female').insert()
+            Movie(title='Coco', release_date=datetime(2017, 11, 22)).insert()
+        res = self.post('/movies/1/actors/1')
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def assert_duplicates_wait(self, store):
+        self.assertEqual(store.claim('k'), ('run', None))
+        self.assertEqual(store.claim('k'), ('wait', None))
+        waiter = threading.Thread(target=store.wait, args=('k', 5))
+        waiter.start()
+        store.store('k', {'status': 200}, 60)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(store.claim('k'), ('done', {'status': 200}))
+        self.assertEqual(store.claim('other'), ('run', None))
+        store.release('other')
+        self.assertEqual(store.claim('other'), ('run', None))
+
+    def test_local_store_coalesces_duplicates(self):
+        self.assert_duplicates_wait(LocalStore())
+
+    def test_shared_store_coalesces_duplicates(self):
+        self.assert_duplicates_wait(SharedStore(StandInRedis(), poll_interval=0.001))
+
+    def test_local_store_evicts(self):
+        store = LocalStore(maxsize=2)
+        for key in 'abc':
+            store.claim(key)
+            store.store(key, {'status': 200}, 60)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.claim('a'), ('run', None))
+
+
+class ChangeFeedTestCase(LocalAppTestCase):
+    """GET /changes returns the writes since a cursor, deletes as tombstones"""
+
+    def setUp(self):
+        super().setUp()
+        self.headers = self.signer.headers([
+            'post:actor', 'patch:actor', 'post:movie', 'delete:movie', 'post:assign', 'delete:assign'])
+        self.client.post('/actors', json={'name': 'Ann', 'age': 30, 'gender': 'female'}, headers=self.headers)
+        self.client.post('/movies', json={'title': 'Coco', 'release_date': 1511308800}, headers=self.headers)
+        self.client.post('/movies/1/actors/1', headers=self.headers)
+
+    def changes(self, since=None, **args):
+        if since is not None:
+            args['since'] = since
+        res = self.client.get('/changes', query_string=args)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def summary(self, data):
+        return [(change['type'], change['id'], change['deleted']) for change in data['changes']]
+
+    def test_feed_from_the_start(self):
+        data = self.changes()
+        self.assertEqual(self.summary(data), [('actor', 1, False), ('movie', 1, False), ('assign', 1, False)])
+        self.assertEqual(data['changes'][0]['row']['name'], 'Ann')
+        self.assertIsNotNone(data['changes'][0]['row']['updated_at'])
+        assign = data['changes'][2]['row']
+        self.assertEqual((assign['movie_id'], assign['actor_id']), (1, 1))
+        self.assertFalse(data['more'])
+        # nothing new: the same cursor comes back
+        self.assertEqual(self.changes(data['next']), {'success': True, 'changes': [], 'next': data['next'], 'more': False})
+
+    def test_only_the_deltas(self):
+        since = self.changes()['next']
+        self.client.patch('/actors/1', json={'age': 31}, headers=self.headers)
+        self.client.patch('/actors/1', json={'age': 32}, headers=self.headers)
+        self.client.post('/movies', json={'title': 'Cars', 'release_date': 1149811200}, headers=self.headers)
+        # the assign and, ON DELETE CASCADE, its movie
+        self.client.delete('/movies/1', headers=self.headers)
+        data = self.changes(since)
+        self.assertEqual(self.summary(data),
+                         [('actor', 1, False), ('movie', 2, False), ('assign', 1, True), ('movie', 1, True)])
+        self.assertEqual(data['changes'][0]['row']['age'], 32)
+        self.assertNotIn('row', data['changes'][3])
+
+    def test_pages(self):
+        with self.app.app_context():
+            bulk_insert(Actor, [{'name': 'actor {}'.format(i)} for i in range(5)])
+            db.session.commit()
+        seen, since = [], None
+        while True:
+            data = self.changes(since, limit=3)
+            seen += self.summary(data)
+            since = data['next']
+            if not data['more']:
+                break
+        self.assertEqual(len(seen), 8)
+        self.assertEqual([id for kind, id, _ in seen if kind == 'actor'], [1, 2, 3, 4, 5, 6])
+
+    def test_counts_alone_are_not_changes(self):
+        since = self.changes()['next']
+        self.client.delete('/movies/1/actors/1', headers=self.headers)
+        self.assertEqual(self.summary(self.changes(since)), [('assign', 1, True)])
+
+    def test_bad_cursor(self):
+        self.assertEqual(self.client.get('/changes?since=nope').status_code, 400)
+        self.assertEqual(self.client.get('/changes?limit=0').status_code, 400)
+
+
+class RateLimitTestCase(LocalAppTestCase):
+    """Token buckets per client: the IP for public routes, the token subject otherwise"""
+
+    def make_client(self, **config):
+        return self.make_app(**dict({'RATE_LIMIT': (1, 2)}, **config)).test_client()
+
+    def statuses(self, client, path, count, method='GET', **kwargs):
+        return [client.open(path, method=method, **kwargs).status_code for _ in range(count)]
+
+    def test_public_routes_limited_per_address(self):
+        client = self.make_client()
+        self.assertEqual(self.statuses(client, '/actors', 3), [200, 200, 429])
+        res = client.get('/movies')
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(res.data)['error'], 429)
+
+    def test_protected_routes_limited_per_subject(self):
+        client = self.make_client()
+        jane = self.signer.headers(['post:actor'], sub='auth0|jane')
+        tom = self.signer.headers(['post:actor'], sub='auth0|tom')
+        self.assertEqual(self.statuses(client, '/actors', 3, 'POST', json={'name': 'Jane'}, headers=jane),
+                         [200, 200, 429])
+        # the same address, another token
+        self.assertEqual(self.statuses(client, '/actors', 1, 'POST', json={'name': 'Tom'}, headers=tom), [200])
+
+    def test_off_by_default(self):
+        self.assertEqual(self.statuses(self.client, '/actors', 60), [200] * 60)
+
+    def test_requests_without_valid_token_limited_per_address(self):
+        client = self.make_client()
+        bad = {'Authorization': 'Bearer not.a.token'}
+        self.assertEqual(self.statuses(client, '/actors', 3, 'POST', json={'name': 'Jane'}, headers=bad),
+                         [401, 401, 429])
+        self.assertEqual(self.statuses(client, '/movies', 1), [429])
+        # a valid token has a bucket of its own
+        jane = self.signer.headers(['post:actor'], sub='auth0|jane')
+        self.assertEqual(self.statuses(client, '/actors', 1, 'POST', json={'name': 'Jane'}, headers=jane), [200])
+
+    def test_limits_per_route(self):
+        client = self.make_client(RATE_LIMITS={'search_rows': (1, 1), 'get_movies': (0, 1)})
+        self.assertEqual(self.statuses(client, '/search?q=a', 2), [200, 429])
+        self.assertEqual(self.statuses(client, '/movies', 5), [200] * 5)
+        self.assertEqual(self.statuses(client, '/actors', 3), [200, 200, 429])
+
+    def test_address_behind_proxy(self):
+        client = self.make_client(RATE_LIMIT_PROXIES=1)
+        for address in ('10.0.0.1', '10.0.0.2'):
+            headers = {'X-Forwarded-For': '1.2.3.4, ' + address}
+            self.assertEqual(self.statuses(client, '/actors', 3, headers=headers), [200, 200, 429])
+
+    def test_shared_buckets(self):
+        store = ratelimit.SharedBuckets(StandInRedis())
+        workers = [self.make_client(RATE_LIMIT_STORE=store) for _ in range(2)]
+        self.assertEqual([worker.get('/actors').status_code for worker in workers * 2], [200, 200, 429, 429])
+
+    def test_bucket_refills(self):
+        state, retry_after = ratelimit.take_token((0.5, 10.0), 10.0, 2, 4)
+        self.assertEqual(retry_after, 0.25)
+        state, retry_after = ratelimit.take_token(state, 10.25, 2, 4)
+        self.assertEqual((state, retry_after), ((0.0, 10.25), 0))
+        self.assertEqual(ratelimit.take_token(None, 0.0, 2, 4)[0], (3, 0.0))
+        self.assertEqual(ratelimit.parse_limits('search=2/10, get_actors=5'),
+                         {'search': (2.0, 10), 'get_actors': (5.0, 5)})
+
+
+class UnitOfWorkTestCase(LocalAppTestCase):
+    """The writes of a request are committed once, when it succeeds"""
+
+    def make_app(self, **config):
+        app = super().make_app(**config)
+
+        @app.route('/test/cast', methods=['POST'])
+        def create_cast():
+            movie = Movie(title='Coco', release_date=datetime(2017, 11, 22))
+            movie.insert()
+            for name in request.json['names']:
+                actor = Actor(name=name, age=30, gender='female')
+                actor.insert()
+                Assign(movie_id=movie.id, actor_id=actor.id).insert()
+            if request.json.get('fail'):
+                abort(422)
+            return '', 204
+
+        @app.route('/test/savepoint', methods=['POST'])
+        def keep_staged_writes():
+            Actor(name='Ann', age=30, gender='female').insert()
+            try:
+                with savepoint():
+                    Movie(title='Coco', release_date=datetime(2017, 11, 22)).insert()
+                    Assign(movie_id=1, actor_id=99).insert()
+            except exc.IntegrityError:
+                pass
+            # no movie 1 any more: the assign is refused without losing Ann
+            return jsonify({'assign': Assign.link(1, 1)})
+
+        @app.route('/test/bulk-savepoint', methods=['POST'])
+        def keep_bulk_writes():
+            ids = bulk_insert(Actor, [{'name': 'Ann', 'age': 30, 'gender': 'female'},
+                                      {'name': 'Bob', 'age': 40, 'gender': 'male'}])
+            bulk_update(Actor, [{'id': ids[0], 'age': 31}])
+            try:
+                with savepoint():
+                    Assign(movie_id=1, actor_id=ids[0]).insert()
+            except exc.IntegrityError:
+                pass
+            return '', 204
+
+        return app
+
+    def commits(self, app, path, **kwargs):
+        counted = []
+        listener = lambda conn: counted.append(conn)
+        event.listen(Engine, 'commit', listener)
+        try:
+            res = app.test_client().post(path, **kwargs)
+        finally:
+            event.remove(Engine, 'commit', listener)
+        return res, len(counted)
+
+    def test_one_commit_per_request(self):
+        app = self.app
+        res, commits = self.commits(app, '/test/cast', json={'names': ['Ann', 'Bob']})
+        self.assertEqual((res.status_code, commits), (204, 1))
+        with app.app_context():
+            self.assertEqual(Movie.query.get(1).cast_count, 2)
+        body = app.test_client().get('/metrics').data.decode()
+        self.assertIn('http_request_db_commits_total{method="POST",route="/test/cast"} 1', body)
+
+    def test_commit_per_write_without_unit_of_work(self):
+        app = self.make_app(UNIT_OF_WORK=False)
+        res, commits = self.commits(app, '/test/cast', json={'names': ['Ann', 'Bob']})
+        self.assertEqual((res.status_code, commits), (204, 5))
+
+    def test_failed_request_writes_nothing(self):
+        app = self.app
+        client = app.test_client()
+        self.assertEqual(json.loads(client.get('/movies').data)['total_movies'], 0)
+        res, commits = self.commits(app, '/test/cast', json={'names': ['Ann'], 'fail': True})
+        self.assertEqual((res.status_code, commits), (422, 0))
+        with app.app_context():
+            self.assertEqual((Movie.query.count(), Actor.query.count(), Assign.query.count()), (0, 0, 0))
+        # the cache is invalidated by committed writes only
+        self.commits(app, '/test/cast', json={'names': []})
+        self.assertEqual(json.loads(client.get('/movies').data)['total_movies'], 1)
+
+    def test_savepoint_keeps_staged_writes(self):
+        app = self.app
+        res, commits = self.commits(app, '/test/savepoint')
+        self.assertEqual(json.loads(res.data), {'assign': None})
+        self.assertEqual(commits, 1)
+        with app.app_context():
+            self.assertEqual([actor.name for actor in Actor.query.all()], ['Ann'])
+            self.assertEqual((Movie.query.count(), Assign.query.count()), (0, 0))
+
+    def test_savepoint_keeps_bulk_writes(self):
+        app = self.app
+        res, commits = self.commits(app, '/test/bulk-savepoint')
+        self.assertEqual((res.status_code, commits), (204, 1))
+        with app.app_context():
+            self.assertEqual([(actor.name, actor.age) for actor in Actor.query.order_by(Actor.id)],
+                             [('Ann', 31), ('Bob', 40)])
+            self.assertEqual(Assign.query.count(), 0)
+
+
+class MetricsTestCase(LocalAppTestCase):
+    """Request timing, SQL instrumentation and the /metrics endpoint"""
+
+    def test_metrics_count_requests_and_queries(self):
+        self.client.get('/actors')
+        self.client.post('/actors', json={'name': 'a', 'age': 30, 'gender': 'male'},
+                         headers=self.signer.headers(['post:actor']))
+        body = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('http_requests_total{method="GET",route="/actors",status="200"} 1', body)
+        self.assertIn('http_requests_total{method="POST",route="/actors",status="200"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/actors"} 1', body)
+        queries = re.search(r'http_request_db_queries_total\{method="GET",route="/actors"\} (\d+)', body)
+        self.assertGreater(int(queries.group(1)), 0)
+        auth = re.search(r'http_request_auth_seconds_total\{method="POST",route="/actors"\} (\S+)', body)
+        self.assertGreater(float(auth.group(1)), 0)
+        self.assertIn('token_cache_size', body)
+        self.assertIn('response_cache_misses', body)
+
+    def test_failing_statements_leave_nothing_on_the_connection(self):
+        with self.app.app_context(), db.engine.connect() as conn:
+            info = repr(conn.info)
+            for _ in range(3):
+                with self.assertRaises(exc.OperationalError):
+                    conn.exec_driver_sql('SELECT * FROM missing')
+            conn.exec_driver_sql('SELECT 1')
+            self.assertEqual(repr(conn.info), info)
+
+    def test_slow_query_log_is_opt_in(self):
+        with self.assertLogs('capstone.sql', 'WARNING') as logs:
+            self.client.get('/actors')
+            logging.getLogger('capstone.sql').warning('done')
+        self.assertEqual(logs.output, ['WARNING:capstone.sql:done'])
+
+        self.app.config['SLOW_QUERY_MS'] = 0.000001
+        with self.assertLogs('capstone.sql', 'WARNING') as logs:
+            self.client.get('/actors?limit=1')
+        self.assertIn('slow query', logs.output[0])
+        self.assertIn('FROM "Actor"', logs.output[0])
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file